@@ -0,0 +1,247 @@
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+import config
+import models
+import schemas
+from database import SessionLocal
+from membership_cache import bump_version, read_version
+from message_cache import message_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Архив старых сообщений.
+# Сообщения старше порога сервера переносятся из таблицы messages в
+# append-only файлы-сегменты archive/<channel_id>/<first_id>.seg. Сегмент
+# состоит из независимо сжатых блоков по ARCHIVE_BLOCK_MESSAGES сообщений,
+# а таблица archive_blocks хранит для каждого блока диапазон id и смещение,
+# так что чтение распаковывает только нужные блоки, а не весь сегмент.
+
+_VERSION_KEY = "archive"
+
+class ArchiveIndex:
+    """
+    Which channels have archived blocks, so reading a short channel does
+    not query archive_blocks every time. Archiving bumps the shared
+    "archive" version and other processes drop their flags when they
+    notice it (checked every ARCHIVE_VERSION_CHECK_MS).
+    """
+    def __init__(self, check_interval_ms: int, max_entries: int):
+        self.check_interval = check_interval_ms / 1000
+        self.max_entries = max_entries
+        self.flags: Dict[int, bool] = {}
+        self.version: Optional[int] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def has_archive(self, db: Session, channel_id: int) -> bool:
+        if time.monotonic() - self.checked_at >= self.check_interval:
+            version = read_version(db, _VERSION_KEY)
+            with self.lock:
+                self.checked_at = time.monotonic()
+                if version != self.version:
+                    self.flags.clear()
+                    self.version = version
+        with self.lock:
+            flag = self.flags.get(channel_id)
+        if flag is not None:
+            return flag
+        flag = db.query(models.ArchiveBlock.id)\
+            .filter(models.ArchiveBlock.channel_id == channel_id)\
+            .first() is not None
+        with self.lock:
+            if len(self.flags) >= self.max_entries:
+                self.flags.clear()
+            self.flags[channel_id] = flag
+        return flag
+
+    def invalidate(self, channel_id: int) -> None:
+        with self.lock:
+            self.flags.pop(channel_id, None)
+
+def _compress(data: bytes):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this archive block")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def _segment_path(db: Session, channel_id: int, first_message_id: int, size: int) -> str:
+    last_block = db.query(models.ArchiveBlock)\
+        .filter(models.ArchiveBlock.channel_id == channel_id)\
+        .order_by(models.ArchiveBlock.max_message_id.desc())\
+        .first()
+    if last_block and last_block.byte_offset + last_block.byte_length + size <= config.ARCHIVE_SEGMENT_MAX_BYTES:
+        return last_block.segment
+    return os.path.join(str(channel_id), f"{first_message_id:012d}.seg")
+
+def _append_block(segment: str, data: bytes) -> int:
+    path = os.path.join(config.ARCHIVE_DIR, segment)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return offset
+
+def _read_block(block: models.ArchiveBlock) -> List[Dict]:
+    with open(os.path.join(config.ARCHIVE_DIR, block.segment), "rb") as f:
+        f.seek(block.byte_offset)
+        data = f.read(block.byte_length)
+    return [json.loads(line) for line in _decompress(block.codec, data).splitlines()]
+
+def _archive_batch(db: Session, channel_id: int, messages: List[models.Message]):
+    ids = [message.id for message in messages]
+    reactors: Dict[int, Dict[str, List[int]]] = {}
+    rows = db.execute(
+        models.message_reactions.select().where(models.message_reactions.c.message_id.in_(ids))
+    )
+    for message_id, user_id, emoji in rows:
+        reactors.setdefault(message_id, {}).setdefault(emoji, []).append(user_id)
+
+    lines = []
+    for message in messages:
+        row = schemas.Message.model_validate(message).model_dump(
+            mode="json", exclude={"reaction_counts", "is_archived"}
+        )
+        row["reactors"] = reactors.get(message.id, {})
+        lines.append(json.dumps(row, ensure_ascii=False))
+    codec, data = _compress("\n".join(lines).encode())
+
+    # Сначала блок попадает на диск, потом в индекс: при сбое между шагами
+    # остается лишь неиспользуемый хвост сегмента, сообщения не теряются
+    segment = _segment_path(db, channel_id, ids[0], len(data))
+    offset = _append_block(segment, data)
+    db.add(models.ArchiveBlock(
+        channel_id=channel_id,
+        min_message_id=ids[0],
+        max_message_id=ids[-1],
+        message_count=len(ids),
+        segment=segment,
+        byte_offset=offset,
+        byte_length=len(data),
+        codec=codec
+    ))
+    db.execute(models.message_reactions.delete().where(models.message_reactions.c.message_id.in_(ids)))
+    db.query(models.MessageMention)\
+        .filter(models.MessageMention.message_id.in_(ids))\
+        .delete(synchronize_session=False)
+    db.query(models.Message)\
+        .filter(models.Message.id.in_(ids))\
+        .delete(synchronize_session=False)
+    bump_version(db, _VERSION_KEY)
+    db.commit()
+    archive_index.invalidate(channel_id)
+
+def archive_channel(db: Session, channel_id: int, cutoff: datetime) -> int:
+    """
+    Move messages of a channel created before `cutoff` into the archive.
+    Returns the number of archived messages.
+    """
+    archived = 0
+    while True:
+        messages = db.query(models.Message)\
+            .filter(models.Message.channel_id == channel_id, models.Message.created_at < cutoff)\
+            .order_by(models.Message.id)\
+            .limit(config.ARCHIVE_BLOCK_MESSAGES)\
+            .all()
+        if not messages:
+            break
+        _archive_batch(db, channel_id, messages)
+        archived += len(messages)
+        if len(messages) < config.ARCHIVE_BLOCK_MESSAGES:
+            break
+    if archived:
+        message_cache.drop_channel(channel_id)
+    return archived
+
+def archive_old_messages(db: Session) -> int:
+    """
+    Archive old messages of every server using its archive threshold.
+    """
+    archived = 0
+    now = datetime.utcnow()
+    for server in db.query(models.Server).all():
+        days = (server.settings or {}).get("archive_after_days", config.ARCHIVE_AFTER_DAYS)
+        if days is None:
+            continue
+        cutoff = now - timedelta(days=days)
+        channel_ids = [
+            channel_id for (channel_id,) in
+            db.query(models.Channel.id).filter(models.Channel.server_id == server.id)
+        ]
+        for channel_id in channel_ids:
+            archived += archive_channel(db, channel_id, cutoff)
+    return archived
+
+def iter_archived_messages(db: Session, channel_id: int, before: Optional[int] = None,
+                           after: Optional[int] = None, newest_first: bool = True) -> Iterator[Dict]:
+    """
+    Yield archived message rows of a channel one block at a time.
+    """
+    query = db.query(models.ArchiveBlock).filter(models.ArchiveBlock.channel_id == channel_id)
+    if before is not None:
+        query = query.filter(models.ArchiveBlock.min_message_id < before)
+    if after is not None:
+        query = query.filter(models.ArchiveBlock.max_message_id > after)
+    order = models.ArchiveBlock.max_message_id
+    blocks = query.order_by(order.desc() if newest_first else order).all()
+
+    for block in blocks:
+        rows = _read_block(block)
+        if newest_first:
+            rows.reverse()
+        for row in rows:
+            if before is not None and row["id"] >= before:
+                continue
+            if after is not None and row["id"] <= after:
+                continue
+            yield row
+
+def to_message(row: Dict, user_id: Optional[int] = None) -> schemas.Message:
+    reactors = row.pop("reactors", {})
+    row["reaction_counts"] = [
+        {"emoji": emoji, "count": len(users), "me": user_id in users}
+        for emoji, users in sorted(reactors.items())
+    ]
+    row["is_archived"] = True
+    return schemas.Message.model_validate(row)
+
+def read_messages(db: Session, channel_id: int, before: Optional[int], limit: int,
+                  user_id: Optional[int] = None) -> List[schemas.Message]:
+    """
+    Newest archived messages of a channel older than `before`.
+    """
+    messages = []
+    for row in iter_archived_messages(db, channel_id, before=before):
+        messages.append(to_message(row, user_id))
+        if len(messages) >= limit:
+            break
+    return messages
+
+# Create a global instance
+archive_index = ArchiveIndex(config.ARCHIVE_VERSION_CHECK_MS, config.MEMBERSHIP_CACHE_MAX_ENTRIES)
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        print(f"Archived {archive_old_messages(db)} messages")
+    finally:
+        db.close()
@@ -0,0 +1,137 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+import schemas
+from membership_cache import membership_cache, bump_version_async
+from user_cache import user_cache
+
+# Асинхронные варианты функций crud для async def обработчиков.
+# Синхронный crud остается для обычных def маршрутов, которые FastAPI
+# выполняет в пуле потоков.
+
+# User operations
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+async def update_last_login(db: AsyncSession, user_id: int) -> None:
+    await db.execute(
+        update(models.User)
+        .where(models.User.id == user_id)
+        .values(last_login=datetime.now())
+    )
+    await db.commit()
+    user_cache.invalidate(user_id)
+
+# Server operations
+async def get_channel(db: AsyncSession, channel_id: int) -> Optional[models.Channel]:
+    return await db.get(models.Channel, channel_id)
+
+async def get_server_member(db: AsyncSession, user_id: int, server_id: int) -> Optional[models.ServerMember]:
+    result = await db.execute(
+        select(models.ServerMember).where(
+            models.ServerMember.user_id == user_id,
+            models.ServerMember.server_id == server_id
+        )
+    )
+    return result.scalars().first()
+
+async def is_user_server_member(db: AsyncSession, user_id: int, server_id: int) -> bool:
+    return await membership_cache.get_async(db, user_id, server_id) is not None
+
+async def get_server_by_invite_code(db: AsyncSession, invite_code: str) -> Optional[models.Server]:
+    # Ленивые связи в async недоступны, поэтому сервер берем одним JOIN
+    result = await db.execute(
+        select(models.Server)
+        .join(models.InviteCode, models.InviteCode.server_id == models.Server.id)
+        .where(
+            models.InviteCode.code == invite_code,
+            (models.InviteCode.expires_at.is_(None)) | (models.InviteCode.expires_at >= datetime.utcnow())
+        )
+    )
+    return result.scalars().first()
+
+async def add_user_to_server(db: AsyncSession, user_id: int, server_id: int) -> models.ServerMember:
+    db_member = await get_server_member(db, user_id, server_id)
+    if db_member:
+        return db_member
+
+    db_member = models.ServerMember(
+        user_id=user_id,
+        server_id=server_id,
+        role_type=models.RoleType.MEMBER
+    )
+    db.add(db_member)
+    version = await bump_version_async(db)
+    await db.commit()
+    membership_cache.invalidate(server_id, user_id, version)
+    return db_member
+
+# Mention operations
+async def get_pending_mentions(db: AsyncSession, user_id: int, after: int):
+    result = await db.execute(
+        select(func.count(), func.max(models.MessageMention.message_id)).where(
+            models.MessageMention.user_id == user_id,
+            models.MessageMention.message_id > after
+        )
+    )
+    return result.one()
+
+# Media operations
+async def get_blob(db: AsyncSession, sha256: str) -> Optional[models.Blob]:
+    return await db.get(models.Blob, sha256)
+
+async def has_uploaded_blob(db: AsyncSession, user_id: int, sha256: str) -> bool:
+    result = await db.execute(
+        select(models.Media.id).where(
+            models.Media.sha256 == sha256,
+            models.Media.uploaded_by_id == user_id
+        ).limit(1)
+    )
+    return result.first() is not None
+
+async def reference_blob(db: AsyncSession, sha256: str) -> bool:
+    """
+    Add a reference to a stored blob. False if there is no such blob.
+    """
+    result = await db.execute(
+        update(models.Blob)
+        .where(models.Blob.sha256 == sha256)
+        .values(ref_count=models.Blob.ref_count + 1, released_at=None)
+    )
+    return result.rowcount > 0
+
+async def acquire_blob(db: AsyncSession, sha256: str, size: int, content_type: str) -> bool:
+    """
+    Add a reference to the blob with this hash, creating its row if needed.
+    Returns True for a new row: the caller must put the file in place
+    before committing.
+    """
+    dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+    result = await db.execute(
+        dialect.insert(models.Blob.__table__)
+        .values(sha256=sha256, size=size, content_type=content_type, ref_count=1)
+        .on_conflict_do_nothing()
+    )
+    if result.rowcount:
+        return True
+    await reference_blob(db, sha256)
+    return False
+
+async def create_media(db: AsyncSession, media: schemas.MediaCreate, uploaded_by_id: int, channel_id: int,
+                       sha256: Optional[str] = None) -> models.Media:
+    db_media = models.Media(
+        **media.dict(),
+        sha256=sha256,
+        uploaded_by_id=uploaded_by_id,
+        channel_id=channel_id
+    )
+    db.add(db_media)
+    await db.commit()
+    await db.refresh(db_media)
+    return db_media
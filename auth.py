@@ -1,8 +1,8 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Dict, Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 import config
@@ -11,6 +11,10 @@ import re
 from database import *
 import models
 import crud
+from membership_cache import Membership, membership_cache
+from permissions import Permission, granted_permissions
+from user_cache import UserSnapshot, user_cache
+from token_cache import token_cache
 import pyotp
 import qrcode
 from io import BytesIO
@@ -22,7 +26,7 @@ ALGORITHM = config.ALGORITHM  # Use the same algorithm as config.py
 ACCESS_TOKEN_EXPIRE_MINUTES = config.ACCESS_TOKEN_EXPIRE_MINUTES
 
 # Настройки паролей
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -43,6 +47,15 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
         print(f"Error verifying password: {str(e)}")
         return False
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """
+    Whether a hash was made with outdated parameters (e.g. another bcrypt cost).
+    """
+    try:
+        return pwd_context.needs_update(hashed_password)
+    except Exception:
+        return False
+
 def get_password_hash(password: str) -> str:
     """
     Hash a password.
@@ -79,9 +92,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
             detail="Could not create access token"
         )
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> UserSnapshot:
     """
     Get the current user from the JWT token.
+    Returns a cached snapshot, not an ORM object: routes that change the
+    user load it with crud.get_user.
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -90,7 +105,7 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     )
     
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = token_cache.decode(token)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -98,18 +113,91 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         print(f"JWT decode error: {str(e)}")
         raise credentials_exception
     
-    user = crud.get_user_by_email(db, email=email)
-    if user is None:
+    user = user_cache.get(db, email)
+    if user is None or not token_version_matches(payload, user):
         raise credentials_exception
+    if not user.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
     
     return user
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def token_version_matches(payload: dict, user) -> bool:
+    """
+    Tokens issued before the user's tokens were revoked carry an older "ver".
+    """
+    return payload.get("ver", 0) == (user.token_version or 0)
+
+def has_permission(db: Session, user_id: int, permission: Permission,
+                   server_id: Optional[int] = None, channel_id: Optional[int] = None) -> bool:
+    """
+    Check a permission of a user in a server or, with channel overrides
+    applied, in a channel.
+    """
+    channel = None
+    if channel_id is not None:
+        channel = membership_cache.get_channel(db, channel_id)
+        if channel is None:
+            return False
+        server_id = channel.server_id
+    membership = membership_cache.get(db, user_id, server_id)
+    if membership is None:
+        return False
+    mask = membership.channel_mask(channel) if channel is not None else membership.mask
+    return mask & permission == permission
+
+def require(permission: Permission):
+    """
+    Route dependency checking a permission against the server or channel
+    taken from the path (server_id, channel_id or role_id), e.g.
+
+        @app.put("/channels/{channel_id}", dependencies=[Depends(auth.require(Permission.MANAGE_CHANNELS))])
+
+    The member's roles are compiled into a bitmask once and cached, so the
+    check itself is a single bit test. Returns the Membership.
+    """
+    def dependency(request: Request, current_user: UserSnapshot = Depends(get_current_user),
+                   db: Session = Depends(get_db)):
+        path_params = request.path_params
+        channel = None
+        if "channel_id" in path_params:
+            channel = membership_cache.get_channel(db, int(path_params["channel_id"]))
+            if channel is None:
+                raise HTTPException(status_code=404, detail="Channel not found")
+            server_id = channel.server_id
+        elif "server_id" in path_params:
+            server_id = int(path_params["server_id"])
+            if membership_cache.get_owner_id(db, server_id) is None:
+                raise HTTPException(status_code=404, detail="Server not found")
+        elif "role_id" in path_params:
+            db_role = crud.get_role(db, int(path_params["role_id"]))
+            if db_role is None:
+                raise HTTPException(status_code=404, detail="Role not found")
+            # Сессия держит объекты по слабым ссылкам: без ссылки из запроса
+            # маршрут загрузил бы роль второй раз
+            request.state.role = db_role
+            server_id = db_role.server_id
+        else:
+            raise RuntimeError(f"Cannot check {permission!r} for {request.url.path}: no server in path")
+
+        membership = membership_cache.get(db, current_user.id, server_id)
+        if membership is None:
+            raise HTTPException(status_code=403, detail="Not a member of this server")
+        mask = membership.channel_mask(channel) if channel is not None else membership.mask
+        if mask & permission != permission:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        return membership
+    return dependency
+
+def check_grant(membership: Membership, role_permissions: Optional[Dict[str, Any]]) -> None:
+    """
+    Refuse to give a role permissions its editor does not hold. Only the
+    owner can grant ADMINISTRATOR.
+    """
+    granted = granted_permissions(role_permissions)
+    if granted & Permission.ADMINISTRATOR and not membership.is_owner:
+        raise HTTPException(status_code=403, detail="Only the server owner can grant administrator")
+    if granted & ~membership.mask:
+        raise HTTPException(status_code=403, detail="Cannot grant permissions you do not have")
 
 def generate_totp_secret() -> str:
     return pyotp.random_base32()
@@ -132,27 +220,3 @@ def generate_totp_qr_code(secret: str, email: str) -> str:
     img_str = base64.b64encode(buffered.getvalue()).decode()
     
     return f"data:image/png;base64,{img_str}"
-
-def check_login_attempts(db: Session, email: str, ip_address: str) -> bool:
-    """
-    Check if there have been too many failed login attempts.
-    Returns True if login is allowed, False if too many attempts.
-    """
-    try:
-        user = crud.get_user_by_email(db, email)
-        if not user:
-            return True  # Allow attempts for non-existent users
-        
-        recent_attempts = db.query(models.LoginHistory)\
-            .filter(
-                models.LoginHistory.user_id == user.id,
-                models.LoginHistory.ip_address == ip_address,
-                models.LoginHistory.success == False,
-                models.LoginHistory.login_time >= datetime.utcnow() - timedelta(minutes=15)
-            )\
-            .count()
-        
-        return recent_attempts < 5
-    except Exception as e:
-        print(f"Error checking login attempts: {str(e)}")
-        return True  # Allow login attempt if there's an error checking 
\ No newline at end of file
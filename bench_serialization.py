@@ -0,0 +1,65 @@
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import models
+import schemas
+from serialization import dump_list
+
+# Стоимость сериализации страницы сообщений на элемент: путь FastAPI
+# (response_model + jsonable_encoder + json) против TypeAdapter.dump_json.
+# Запуск: python bench_serialization.py [repeats]
+
+def _messages(count: int):
+    started = datetime(2024, 1, 1)
+    messages = []
+    for i in range(count):
+        message = models.Message(
+            id=i + 1,
+            content=f"message {i} with some text @user{i % 7}",
+            author_id=i % 50 + 1,
+            channel_id=1,
+            created_at=started + timedelta(seconds=i),
+            is_edited=i % 10 == 0,
+            attachments=[],
+            mentions=[i % 7] if i % 3 == 0 else [],
+            role_mentions=[],
+            reply_count=i % 4
+        )
+        message.reaction_counts = [
+            schemas.ReactionCount(emoji="👍", count=i % 5 + 1, me=i % 2 == 0)
+        ] if i % 2 else []
+        messages.append(message)
+    return messages
+
+def _fastapi_path(field, messages) -> bytes:
+    content = asyncio.run(serialize_response(field=field, response_content=messages, is_coroutine=True))
+    return JSONResponse(content).body
+
+def _measure(function, repeats: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - started) / repeats
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    field = create_response_field(name="Response_read_messages", type_=List[schemas.Message])
+
+    for count in (100, 1000):
+        messages = _messages(count)
+        assert json.loads(_fastapi_path(field, messages)) == json.loads(dump_list(schemas.Message, messages))
+        fastapi_cost = _measure(lambda: _fastapi_path(field, messages), repeats)
+        adapter_cost = _measure(lambda: dump_list(schemas.Message, messages), repeats)
+        print(
+            f"{count:5} items: response_model {fastapi_cost / count * 1e6:7.2f} us/item  "
+            f"TypeAdapter {adapter_cost / count * 1e6:7.2f} us/item  "
+            f"({fastapi_cost / adapter_cost:.1f}x)"
+        )
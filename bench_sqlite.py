@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from database import RoutingSession, create_engines
+import models
+
+# Сравнение пропускной способности SQLite: пул по умолчанию против режима
+# WAL + один писатель + пул только для чтения.
+# Запуск: python bench_sqlite.py [seconds] [writers] [readers]
+
+def _seed(Session):
+    db = Session()
+    try:
+        user = models.User(email="bench@example.com", username="bench", hashed_password="-")
+        db.add(user)
+        db.flush()
+        server = models.Server(name="bench", owner_id=user.id)
+        db.add(server)
+        db.flush()
+        channel = models.Channel(name="bench", server_id=server.id)
+        db.add(channel)
+        db.flush()
+        db.add_all(
+            models.Message(content=f"seed {i}", author_id=user.id, channel_id=channel.id)
+            for i in range(1000)
+        )
+        db.commit()
+        return user.id, channel.id
+    finally:
+        db.close()
+
+def _run(single_writer: bool, seconds: float, writers: int, readers: int):
+    directory = tempfile.mkdtemp()
+    url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    engine, read_engine = create_engines(url, single_writer)
+    Session = sessionmaker(class_=RoutingSession, autoflush=False, bind=engine, read_bind=read_engine)
+    models.Base.metadata.create_all(bind=engine)
+    user_id, channel_id = _seed(Session)
+
+    counts = {"writes": 0, "reads": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def writer():
+        while time.monotonic() < deadline:
+            db = Session()
+            try:
+                db.add(models.Message(content="bench", author_id=user_id, channel_id=channel_id))
+                db.commit()
+                key = "writes"
+            except OperationalError:
+                db.rollback()
+                key = "errors"
+            finally:
+                db.close()
+            with lock:
+                counts[key] += 1
+
+    def reader():
+        while time.monotonic() < deadline:
+            db = Session()
+            try:
+                db.query(models.Message)\
+                    .filter(models.Message.channel_id == channel_id)\
+                    .order_by(models.Message.id.desc())\
+                    .limit(50)\
+                    .all()
+                key = "reads"
+            except OperationalError:
+                key = "errors"
+            finally:
+                db.close()
+            with lock:
+                counts[key] += 1
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    engine.dispose()
+    if read_engine is not None:
+        read_engine.dispose()
+    return {key: value / seconds for key, value in counts.items()}
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    print(f"{seconds}s, {writers} writers, {readers} readers")
+    for name, single_writer in (("default pool", False), ("single writer + WAL", True)):
+        result = _run(single_writer, seconds, writers, readers)
+        print(
+            f"{name:>20}: {result['writes']:8.1f} writes/s  "
+            f"{result['reads']:8.1f} reads/s  {result['errors']:6.1f} errors/s"
+        )
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from typing import Optional
+
+import config
+from database import SessionLocal
+
+# Хранилище файлов по содержимому.
+# Файл лежит в BLOB_DIR/ab/cd/<sha256>, строка blobs считает ссылки из media.
+# Повторная загрузка того же содержимого только увеличивает счетчик, файл не
+# пишется второй раз. Блобы без ссылок удаляет фоновый сборщик, пачками и
+# не раньше BLOB_GC_GRACE_SECONDS после освобождения.
+#
+# Порядок операций исключает гонку загрузки со сборщиком: загрузка сначала
+# пишет строку blobs (и этим берет блокировку записи), потом кладет файл и
+# коммитит. Сборщик удаляет строки и файлы внутри одной транзакции, так что
+# строка без файла никогда не видна.
+
+class BlobStore:
+    def __init__(self, root: str, interval_seconds: int, grace_seconds: int, batch_size: int):
+        self.root = root
+        self.interval = interval_seconds
+        self.grace = grace_seconds
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def url(self, sha256: str) -> str:
+        return f"/media/blobs/{sha256}"
+
+    def place(self, temp_path: str, sha256: str) -> None:
+        """
+        Move a finished upload into its place in the store.
+        """
+        path = self.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def remove(self, sha256: str) -> None:
+        try:
+            os.unlink(self.path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def collect(self) -> int:
+        """
+        Delete unreferenced blobs whose grace period is over. Returns the
+        number of blobs removed.
+        """
+        from crud import delete_unreferenced_blobs  # import inside function to avoid circular dependency
+
+        removed = 0
+        while True:
+            db = SessionLocal()
+            try:
+                hashes = delete_unreferenced_blobs(db, self.grace, self.batch_size)
+                # Файлы удаляются до коммита, пока строки заблокированы
+                for sha256 in hashes:
+                    self.remove(sha256)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"Error collecting blobs: {e}")
+                return removed
+            finally:
+                db.close()
+            removed += len(hashes)
+            if len(hashes) < self.batch_size:
+                if removed:
+                    print(f"Removed {removed} unreferenced blobs")
+                return removed
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.running = True
+                self.wakeup.clear()
+                self.thread = threading.Thread(target=self._run, name="blob-gc", daemon=True)
+                self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self) -> None:
+        while self.running:
+            started = time.monotonic()
+            self.collect()
+            self.wakeup.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+# Create a global instance
+blob_store = BlobStore(
+    config.BLOB_DIR,
+    config.BLOB_GC_INTERVAL_SECONDS,
+    config.BLOB_GC_GRACE_SECONDS,
+    config.BLOB_GC_BATCH_SIZE
+)
@@ -0,0 +1,149 @@
+import gzip
+import zlib
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Сжатие ответов.
+# Кодировка выбирается по Accept-Encoding (brotli, если установлен, иначе
+# gzip). Сжимаются только текстовые ответы от COMPRESSION_MIN_SIZE байт,
+# само сжатие идет в пуле потоков, чтобы не занимать цикл событий. Ответы с
+# уже выставленным Content-Encoding (страницы из кэша сообщений, gzip-экспорт)
+# пропускаются как есть. Потоковые ответы сжимаются по частям.
+
+_COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+_ENCODING_SUFFIXES = {"br": "-br", "gzip": "-gzip"}
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Best supported encoding from an Accept-Encoding header, or None.
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [name for name in candidates if accepted.get(name, accepted.get("*", 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda name: accepted.get(name, accepted.get("*", 0)))
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=config.COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=config.COMPRESSION_GZIP_LEVEL, mtime=0)
+
+def encoding_etag(etag: str, encoding: str) -> str:
+    # У сжатого представления свой сильный ETag
+    if etag.endswith('"') and not etag.startswith("W/"):
+        return etag[:-1] + _ENCODING_SUFFIXES[encoding] + '"'
+    return etag
+
+def strip_encoding_etag(etag: str) -> str:
+    for suffix in _ENCODING_SUFFIXES.values():
+        if etag.endswith(suffix + '"'):
+            return etag[:-len(suffix) - 1] + '"'
+    return etag
+
+class _StreamCompressor:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=config.COMPRESSION_BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(config.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        self.encoding = encoding
+
+    def process(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush(zlib.Z_FINISH)
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = config.COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor: Optional[_StreamCompressor] = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message.get("headers", []))
+                content_type = headers.get("content-type", "")
+                passthrough = "content-encoding" in headers or not content_type.startswith(_COMPRESSIBLE_TYPES)
+                if passthrough:
+                    await send(message)
+                else:
+                    # Заголовки отправим, когда увидим тело
+                    start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(raw=list(start_message.get("headers", [])))
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "etag" in headers:
+                    headers["etag"] = encoding_etag(headers["etag"], encoding)
+                if more_body:
+                    del headers["content-length"]
+                    compressor = _StreamCompressor(encoding)
+                    body = await run_in_threadpool(compressor.process, body)
+                else:
+                    body = await run_in_threadpool(compress, body, encoding)
+                    headers["content-length"] = str(len(body))
+                start_message["headers"] = headers.raw
+                await send(start_message)
+                start_message = None
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+                return
+
+            # Продолжение потокового ответа
+            body = await run_in_threadpool(compressor.process, body) if body else b""
+            if not more_body:
+                body += compressor.finish()
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
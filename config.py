@@ -4,12 +4,33 @@ SERVER_PORT = 8000
 
 # Database configuration
 DATABASE_URL = "sqlite:///./dump.db"
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./dump.db"  # Same database, used by async handlers
+
+# SQLite storage: WAL, one writer connection and a separate read-only pool
+SQLITE_SINGLE_WRITER = True
+SQLITE_READ_POOL_SIZE = 8
+SQLITE_WRITE_TIMEOUT = 30  # Seconds a write waits for the writer connection
+SQLITE_BUSY_TIMEOUT_MS = 5000  # For writers in other processes (async engine, archive CLI)
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # 256MB
+SQLITE_CACHE_SIZE_KB = 16 * 1024  # 16MB page cache per connection
 
 # JWT Configuration
 SECRET_KEY = "hui228"  # Match with main.py and auth.py
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Password hashing: bcrypt cost and the pool that runs it. Hashes with a
+# different cost are rehashed on the next successful login.
+BCRYPT_ROUNDS = 12
+PASSWORD_POOL_WORKERS = 4
+PASSWORD_POOL_MAX_QUEUE = 32  # Queued jobs beyond the workers before returning 429
+
+# Login rate limits as (attempts, window in seconds)
+LOGIN_RATE_LIMIT_PER_IP = (20, 60)
+LOGIN_RATE_LIMIT_FAILURES_PER_ACCOUNT = (5, 15 * 60)
+RATE_LIMIT_MAX_KEYS = 100000
+RATE_LIMIT_REDIS_URL = None  # e.g. "redis://localhost:6379/0" to share limits between workers
+
 # Media configuration
 UPLOAD_DIR = "uploads"
 MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
@@ -19,6 +40,67 @@ ALLOWED_EXTENSIONS = {
     "audio": ["mp3", "wav", "ogg"],
     "document": ["pdf", "doc", "docx", "txt"]
 }
+BLOB_DIR = "uploads/blobs"  # Content-addressed storage: <BLOB_DIR>/ab/cd/<sha256>
+BLOB_GC_INTERVAL_SECONDS = 300
+BLOB_GC_GRACE_SECONDS = 3600  # Unreferenced blobs are kept this long in case the same file comes back
+BLOB_GC_BATCH_SIZE = 500
+
+# Per-request query statistics (Server-Timing header, N+1 warnings).
+# Routes declare a budget with @query_budget(n); strict mode raises instead of logging.
+QUERY_REPEAT_THRESHOLD = 5  # Identical statements per request before warning
+QUERY_BUDGET_DEFAULT = None  # Budget for routes without @query_budget (None = unlimited)
+QUERY_BUDGET_STRICT = False
+
+# Audit and login events are queued and written in batches by a background worker.
+# On a full queue "block" waits up to EVENT_SINK_BLOCK_TIMEOUT seconds, then drops; "drop" drops at once.
+# Async handlers never wait: they always drop.
+EVENT_SINK_MAX_ROWS = 500
+EVENT_SINK_INTERVAL_MS = 10
+EVENT_SINK_MAX_QUEUE = 10000
+EVENT_SINK_OVERFLOW = "block"
+EVENT_SINK_BLOCK_TIMEOUT = 1.0
+
+# Membership cache: other processes' changes are picked up within this interval
+MEMBERSHIP_CACHE_VERSION_CHECK_MS = 1000
+MEMBERSHIP_CACHE_MAX_ENTRIES = 100000
+
+# Authenticated-user cache: other processes' changes are picked up after the TTL
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_MAX_ENTRIES = 10000
+TOKEN_CACHE_MAX_ENTRIES = 10000  # Verified JWTs kept by token digest
+
+# ETags of read-mostly resources: other processes' changes are picked up within this interval
+ETAG_VERSION_CHECK_MS = 1000
+
+# Response compression (brotli is used when installed, gzip otherwise)
+COMPRESSION_MIN_SIZE = 1024  # Smaller responses are sent as is
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+WS_PER_MESSAGE_DEFLATE = True  # Negotiate permessage-deflate on WebSocket connections
+
+# Message cache configuration
+MESSAGE_CACHE_PAGE_SIZE = 100  # Latest messages kept per channel
+MESSAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 32MB across all channels
+MESSAGE_CACHE_COMPRESSED_VARIANTS = 4  # Compressed pages kept per channel
+
+# Message write pipeline: batch inserts into group commits (single process only)
+MESSAGE_WRITE_PIPELINE = False
+MESSAGE_BATCH_MAX_ROWS = 500
+MESSAGE_BATCH_INTERVAL_MS = 5
+
+# Read state acks are coalesced in memory and written at most this often
+READ_STATE_FLUSH_INTERVAL_MS = 1000
+
+# Message archive: old messages move to compressed segment files.
+# Servers can override the age with settings["archive_after_days"] (null disables).
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_BLOCK_MESSAGES = 256
+ARCHIVE_SEGMENT_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+ARCHIVE_VERSION_CHECK_MS = 1000  # How often archiving by another process is noticed
+
+# Rows per keyset batch when streaming exports
+EXPORT_BATCH_SIZE = 500
 
 # Game configuration
 MAX_PLAYERS_PER_GAME = 10
@@ -1,14 +1,29 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, aliased, joinedload, selectinload
+from sqlalchemy import and_, or_, insert, func, case, select, literal, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime, timedelta
 import models, schemas
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set, Tuple
 from fastapi import HTTPException
 import secrets
+from message_cache import message_cache
+from message_writer import message_writer
+import config
+import archive
+from database import run_after_commit
+from notifications import notification_manager
+from event_sink import event_sink
+from membership_cache import membership_cache, bump_version
+from permissions import compile_permissions
+from user_cache import user_cache
+from etags import resource_versions
+
+# Функции только flush-ат изменения: коммит делает UnitOfWorkRoute один раз
+# в конце запроса, а кэш обновляется через run_after_commit.
 
 # User operations
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return db.get(models.User, user_id)
 
 def get_user_by_email(db: Session, email: str):
     print(f"Looking up user with email: {email}")
@@ -26,20 +41,16 @@ def get_users(db: Session, skip: int = 0, limit: int = 100):
 
 def create_user(db: Session, user: schemas.UserCreate):
     from auth import get_password_hash  # import inside function to avoid circular dependency
+    from password_pool import password_pool
     
     print(f"Creating user with email: {user.email}")
     print(f"Password: {user.password}")
     print(f"Password length: {len(user.password)}")
     print(f"Password bytes: {[ord(c) for c in user.password]}")
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = password_pool.run(get_password_hash, user.password)
     print(f"Generated hash: {hashed_password}")
     
-    # Verify the hash immediately
-    from auth import verify_password
-    verification_result = verify_password(user.password, hashed_password)
-    print(f"Immediate verification of generated hash: {verification_result}")
-    
     db_user = models.User(
         email=user.email,
         username=user.username,
@@ -49,8 +60,7 @@ def create_user(db: Session, user: schemas.UserCreate):
         created_at=datetime.utcnow()
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
     return db_user
 
 def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
@@ -62,10 +72,36 @@ def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
     for field, value in update_data.items():
         setattr(db_user, field, value)
     
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
+    _invalidate_user(db, db_user)
+    return db_user
+
+def deactivate_user(db: Session, user_id: int):
+    db_user = get_user(db, user_id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    db_user.is_active = False
+    db.flush()
+    _invalidate_user(db, db_user)
+    return db_user
+
+def revoke_user_tokens(db: Session, user_id: int):
+    db_user = get_user(db, user_id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Токены с прежней версией перестают проходить проверку
+    db_user.token_version = (db_user.token_version or 0) + 1
+    db.flush()
+    _invalidate_user(db, db_user)
     return db_user
 
+def _invalidate_user(db: Session, db_user: models.User):
+    # Снимок пользователя для аутентификации сбрасываем после коммита
+    user_id, email = db_user.id, db_user.email
+    run_after_commit(db, lambda: user_cache.invalidate(user_id, email))
+
 def create_login_history(db: Session, user_id: int, ip_address: str, user_agent: str, success: bool = True):
     db_history = models.LoginHistory(
         user_id=user_id,
@@ -74,25 +110,16 @@ def create_login_history(db: Session, user_id: int, ip_address: str, user_agent:
         success=success
     )
     db.add(db_history)
-    db.commit()
-    db.refresh(db_history)
+    db.flush()
     return db_history
 
-def log_login_attempt(db: Session, ip_address: str, success: bool) -> None:
+def log_login_attempt(db: Session, ip_address: str, success: bool, user_id: Optional[int] = None,
+                      user_agent: Optional[str] = None) -> None:
     """
-    Log a login attempt.
+    Log a login attempt. The entry is queued in the event sink and written
+    in the background, independently of the request's transaction.
     """
-    try:
-        login_history = models.LoginHistory(
-            ip_address=ip_address,
-            success=success,
-            login_time=datetime.utcnow()
-        )
-        db.add(login_history)
-        db.commit()
-    except Exception as e:
-        print(f"Error logging login attempt: {str(e)}")
-        db.rollback()
+    event_sink.add_login_attempt(ip_address, success, user_id=user_id, user_agent=user_agent)
 
 def get_login_history(db: Session, user_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.LoginHistory)\
@@ -102,7 +129,7 @@ def get_login_history(db: Session, user_id: int, skip: int = 0, limit: int = 100
 
 # Server operations
 def get_server(db: Session, server_id: int):
-    return db.query(models.Server).filter(models.Server.id == server_id).first()
+    return db.get(models.Server, server_id)
 
 def get_servers(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Server).offset(skip).limit(limit).all()
@@ -113,11 +140,61 @@ def get_user_servers(db: Session, user_id: int):
         .filter(models.ServerMember.user_id == user_id)\
         .all()
 
+def get_server_bootstrap(db: Session, server_id: int, user_id: int):
+    """
+    Everything the client needs to open a server, in a fixed number of
+    queries: server with roles, the user's membership with its role,
+    member count and channels with read state nested under categories.
+    Returns None if the server does not exist.
+    """
+    server = db.query(models.Server)\
+        .options(selectinload(models.Server.roles))\
+        .filter(models.Server.id == server_id)\
+        .first()
+    if server is None:
+        return None
+
+    membership = db.query(models.ServerMember)\
+        .options(joinedload(models.ServerMember.role))\
+        .filter(models.ServerMember.server_id == server_id, models.ServerMember.user_id == user_id)\
+        .first()
+    member_count = db.query(func.count(models.ServerMember.id))\
+        .filter(models.ServerMember.server_id == server_id)\
+        .scalar()
+
+    # Каналы уже упорядочены по position, раскладываем их по категориям
+    channels = get_server_channels_with_read_state(db, server_id, user_id)
+    categories = {}
+    for channel in channels:
+        if channel.type == models.ChannelType.CATEGORY:
+            channel.channels = []
+            categories[channel.id] = channel
+    uncategorized = []
+    for channel in channels:
+        if channel.id in categories:
+            continue
+        if channel.category_id in categories:
+            categories[channel.category_id].channels.append(channel)
+        else:
+            uncategorized.append(channel)
+
+    return {
+        "server": server,
+        "roles": server.roles,
+        "membership": membership,
+        "permissions": compile_permissions(
+            membership.role_type, membership.role.permissions if membership.role else None,
+            is_owner=server.owner_id == user_id
+        ) if membership else 0,
+        "member_count": member_count,
+        "categories": list(categories.values()),
+        "channels": uncategorized
+    }
+
 def create_server(db: Session, server: schemas.ServerCreate, owner_id: int):
     db_server = models.Server(**server.dict(), owner_id=owner_id)
     db.add(db_server)
-    db.commit()
-    db.refresh(db_server)
+    db.flush()
     
     # Добавляем владельца как участника сервера с ролью ADMIN
     db_member = models.ServerMember(
@@ -126,7 +203,8 @@ def create_server(db: Session, server: schemas.ServerCreate, owner_id: int):
         role_type=models.RoleType.ADMIN
     )
     db.add(db_member)
-    db.commit()
+    db.flush()
+    _invalidate_membership(db, db_server.id)
     
     return db_server
 
@@ -139,8 +217,8 @@ def update_server(db: Session, server_id: int, server: schemas.ServerUpdate):
     for field, value in update_data.items():
         setattr(db_server, field, value)
     
-    db.commit()
-    db.refresh(db_server)
+    db.flush()
+    resource_versions.bump(db, "server", server_id)
     return db_server
 
 def delete_server(db: Session, server_id: int):
@@ -148,12 +226,26 @@ def delete_server(db: Session, server_id: int):
     if not db_server:
         raise HTTPException(status_code=404, detail="Server not found")
     
+    _delete_channel_media(db, [channel.id for channel in db_server.channels])
     db.delete(db_server)
-    db.commit()
+    db.flush()
+    _invalidate_membership(db, server_id)
+    resource_versions.bump(db, "server", server_id)
+    resource_versions.bump(db, "roles", server_id)
     return {"message": "Server deleted successfully"}
 
+def _invalidate_membership(db: Session, server_id: int, user_id: Optional[int] = None):
+    # Сбрасываем кэш членства после коммита, другие процессы увидят новую версию
+    version = bump_version(db)
+    run_after_commit(db, lambda: membership_cache.invalidate(server_id, user_id, version))
+
+def _invalidate_channel_access(db: Session, channel_id: int):
+    # Переопределения прав канала тоже лежат в кэше членства
+    version = bump_version(db)
+    run_after_commit(db, lambda: membership_cache.invalidate_channel(channel_id, version))
+
 def get_role(db: Session, role_id: int):
-    return db.query(models.Role).filter(models.Role.id == role_id).first()
+    return db.get(models.Role, role_id)
 
 def get_server_roles(db: Session, server_id: int):
     return db.query(models.Role).filter(models.Role.server_id == server_id).all()
@@ -161,8 +253,8 @@ def get_server_roles(db: Session, server_id: int):
 def create_role(db: Session, role: schemas.RoleCreate, server_id: int):
     db_role = models.Role(**role.dict(), server_id=server_id)
     db.add(db_role)
-    db.commit()
-    db.refresh(db_role)
+    db.flush()
+    resource_versions.bump(db, "roles", server_id)
     return db_role
 
 def update_role(db: Session, role_id: int, role: schemas.RoleUpdate):
@@ -174,8 +266,9 @@ def update_role(db: Session, role_id: int, role: schemas.RoleUpdate):
     for field, value in update_data.items():
         setattr(db_role, field, value)
     
-    db.commit()
-    db.refresh(db_role)
+    db.flush()
+    _invalidate_membership(db, db_role.server_id)
+    resource_versions.bump(db, "roles", db_role.server_id)
     return db_role
 
 def delete_role(db: Session, role_id: int):
@@ -184,12 +277,14 @@ def delete_role(db: Session, role_id: int):
         raise HTTPException(status_code=404, detail="Role not found")
     
     db.delete(db_role)
-    db.commit()
+    db.flush()
+    _invalidate_membership(db, db_role.server_id)
+    resource_versions.bump(db, "roles", db_role.server_id)
     return {"message": "Role deleted successfully"}
 
 # Channel operations
 def get_channel(db: Session, channel_id: int):
-    return db.query(models.Channel).filter(models.Channel.id == channel_id).first()
+    return db.get(models.Channel, channel_id)
 
 def get_server_channels(db: Session, server_id: int):
     return db.query(models.Channel)\
@@ -200,8 +295,8 @@ def get_server_channels(db: Session, server_id: int):
 def create_channel(db: Session, channel: schemas.ChannelCreate, server_id: int):
     db_channel = models.Channel(**channel.dict(), server_id=server_id)
     db.add(db_channel)
-    db.commit()
-    db.refresh(db_channel)
+    db.flush()
+    _invalidate_channel_access(db, db_channel.id)
     return db_channel
 
 def update_channel(db: Session, channel_id: int, channel: schemas.ChannelUpdate):
@@ -213,8 +308,9 @@ def update_channel(db: Session, channel_id: int, channel: schemas.ChannelUpdate)
     for field, value in update_data.items():
         setattr(db_channel, field, value)
     
-    db.commit()
-    db.refresh(db_channel)
+    db.flush()
+    if "settings" in update_data:
+        _invalidate_channel_access(db, channel_id)
     return db_channel
 
 def delete_channel(db: Session, channel_id: int):
@@ -222,31 +318,128 @@ def delete_channel(db: Session, channel_id: int):
     if not db_channel:
         raise HTTPException(status_code=404, detail="Channel not found")
     
+    _delete_channel_media(db, [channel_id])
     db.delete(db_channel)
-    db.commit()
+    db.flush()
+    _invalidate_channel_access(db, channel_id)
+    run_after_commit(db, lambda: message_cache.drop_channel(channel_id))
     return {"message": "Channel deleted successfully"}
 
 # Message operations
 def get_message(db: Session, message_id: int):
-    return db.query(models.Message).filter(models.Message.id == message_id).first()
+    return db.get(models.Message, message_id)
 
-def get_channel_messages(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Message)\
-        .filter(models.Message.channel_id == channel_id)\
-        .order_by(models.Message.created_at.desc())\
+def get_channel_messages(db: Session, channel_id: int, skip: int = 0, limit: int = 100,
+                         before: Optional[int] = None, user_id: Optional[int] = None):
+    """
+    Newest messages of a channel, ordered by id like the archive. Without
+    skip the page continues into the archive once live messages run out,
+    if the channel has archived messages.
+    """
+    query = db.query(models.Message).filter(models.Message.channel_id == channel_id)
+    if before is not None:
+        query = query.filter(models.Message.id < before)
+    messages = query\
+        .order_by(models.Message.id.desc())\
         .offset(skip).limit(limit).all()
+    if len(messages) < limit and skip == 0 and archive.archive_index.has_archive(db, channel_id):
+        cursor = messages[-1].id if messages else before
+        messages += archive.read_messages(db, channel_id, cursor, limit - len(messages), user_id)
+    return messages
+
+def get_channel_messages_after(db: Session, channel_id: int, after_id: int, limit: int = 500):
+    return db.query(models.Message)\
+        .filter(models.Message.channel_id == channel_id, models.Message.id > after_id)\
+        .order_by(models.Message.id)\
+        .limit(limit).all()
 
 def create_message(db: Session, message: schemas.MessageCreate, author_id: int, channel_id: int):
+    if config.MESSAGE_WRITE_PIPELINE:
+        # Сообщение попадает в пачку и подтверждается после ее коммита
+        values = message_writer.write({
+            **message.dict(),
+            "author_id": author_id,
+            "channel_id": channel_id,
+            "is_edited": False,
+            "reply_count": 0
+        })
+        db_message = models.Message(**values)
+        message_cache.add_message(db_message)
+        db_parent = _load_cached_parent(db, db_message.parent_id)
+        if db_parent:
+            message_cache.update_message(db_parent)
+        return db_message
+
     db_message = models.Message(
         **message.dict(),
         author_id=author_id,
         channel_id=channel_id
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    db.flush()
+    if db_message.parent_id is not None:
+        _bump_reply_count(db, db_message.parent_id, 1, func.now())
+    index_mentions(db, [_mention_row(db_message)])
+    db_parent = _load_cached_parent(db, db_message.parent_id)
+
+    def update_cache():
+        message_cache.add_message(db_message)
+        if db_parent:
+            message_cache.update_message(db_parent)
+    run_after_commit(db, update_cache)
     return db_message
 
+def insert_messages(db: Session, rows: List[Dict[str, Any]]):
+    """
+    Insert a batch of message rows with pre-assigned ids in one statement.
+    The caller commits.
+    """
+    db.execute(insert(models.Message), rows)
+
+    # Обновляем счетчики веток одним UPDATE на каждого родителя
+    replies: Dict[int, List[datetime]] = {}
+    for row in rows:
+        if row.get("parent_id") is not None:
+            replies.setdefault(row["parent_id"], []).append(row["created_at"])
+    for parent_id, created_at in replies.items():
+        _bump_reply_count(db, parent_id, len(created_at), max(created_at))
+
+    index_mentions(db, rows)
+
+def _bump_reply_count(db: Session, parent_id: int, delta: int, last_reply_at=None):
+    values = {models.Message.reply_count: models.Message.reply_count + delta}
+    if last_reply_at is not None:
+        values[models.Message.last_reply_at] = last_reply_at
+    db.query(models.Message)\
+        .filter(models.Message.id == parent_id)\
+        .update(values, synchronize_session=False)
+
+def _load_cached_parent(db: Session, parent_id: Optional[int]) -> Optional[models.Message]:
+    # Счетчики родителя изменились: перечитываем его, если он есть в кэше,
+    # чтобы вызывающий код перерисовал его там
+    if parent_id is None or not message_cache.is_cached(parent_id):
+        return None
+    return db.get(models.Message, parent_id, populate_existing=True)
+
+def get_message_thread(db: Session, message_id: int, max_depth: int = 10,
+                       after: Optional[int] = None, limit: int = 100):
+    """
+    Fetch a reply tree in one round trip using a recursive CTE.
+    Returns (message, depth) pairs ordered by id; `after` is a keyset cursor.
+    """
+    thread = select(models.Message.id, literal(0).label("depth"))\
+        .where(models.Message.id == message_id)\
+        .cte("thread", recursive=True)
+    thread = thread.union_all(
+        select(models.Message.id, thread.c.depth + 1)
+        .where(models.Message.parent_id == thread.c.id, thread.c.depth < max_depth)
+    )
+    query = db.query(models.Message, thread.c.depth)\
+        .join(thread, models.Message.id == thread.c.id)
+    if after is not None:
+        query = query.filter(models.Message.id > after)
+    return query.order_by(models.Message.id).limit(limit).all()
+
 def update_message(db: Session, message_id: int, message: schemas.MessageUpdate):
     db_message = get_message(db, message_id)
     if not db_message:
@@ -259,8 +452,18 @@ def update_message(db: Session, message_id: int, message: schemas.MessageUpdate)
     db_message.is_edited = True
     db_message.edited_at = datetime.utcnow()
     
-    db.commit()
-    db.refresh(db_message)
+    if "mentions" in update_data or "role_mentions" in update_data:
+        previous = {
+            user_id for (user_id,) in db.query(models.MessageMention.user_id)
+            .filter(models.MessageMention.message_id == message_id)
+        }
+        db.query(models.MessageMention)\
+            .filter(models.MessageMention.message_id == message_id)\
+            .delete(synchronize_session=False)
+        index_mentions(db, [_mention_row(db_message)], already_mentioned=previous)
+    
+    db.flush()
+    run_after_commit(db, lambda: message_cache.update_message(db_message))
     return db_message
 
 def delete_message(db: Session, message_id: int):
@@ -268,22 +471,286 @@ def delete_message(db: Session, message_id: int):
     if not db_message:
         raise HTTPException(status_code=404, detail="Message not found")
     
+    channel_id = db_message.channel_id
+    parent_id = db_message.parent_id
     db.delete(db_message)
-    db.commit()
+    if parent_id is not None:
+        # Время последнего ответа пересчитывается по оставшимся ответам,
+        # после удаления последнего из них оно становится NULL
+        reply = aliased(models.Message)
+        last_reply_at = select(func.max(reply.created_at))\
+            .where(reply.parent_id == parent_id, reply.id != message_id)\
+            .scalar_subquery()
+        _bump_reply_count(db, parent_id, -1, last_reply_at)
+    db.query(models.MessageMention)\
+        .filter(models.MessageMention.message_id == message_id)\
+        .delete(synchronize_session=False)
+    db.flush()
+    db_parent = _load_cached_parent(db, parent_id)
+
+    def update_cache():
+        message_cache.remove_message(message_id, channel_id)
+        if db_parent:
+            message_cache.update_message(db_parent)
+    run_after_commit(db, update_cache)
     return {"message": "Message deleted successfully"}
 
-def add_message_reaction(db: Session, message_id: int, user_id: int, emoji: str):
+# Mention operations
+def _mention_row(db_message: models.Message) -> Dict[str, Any]:
+    return {
+        "id": db_message.id,
+        "channel_id": db_message.channel_id,
+        "author_id": db_message.author_id,
+        "content": db_message.content,
+        "mentions": db_message.mentions,
+        "role_mentions": db_message.role_mentions
+    }
+
+def index_mentions(db: Session, rows: List[Dict[str, Any]], already_mentioned: Optional[Set[int]] = None):
+    """
+    Extract mentions of the given message rows into message_mentions.
+    Mentioned roles are expanded to their members, and all rows go in with
+    one bulk insert. Unread mention counters are bumped and online users are
+    notified after the commit; `already_mentioned` users are neither counted
+    nor notified again.
+    """
+    by_channel: Dict[int, List[Dict[str, Any]]] = {}
+    for row in rows:
+        if row.get("mentions") or row.get("role_mentions"):
+            by_channel.setdefault(row["channel_id"], []).append(row)
+    if not by_channel:
+        return
+
+    mention_rows = []
+    counters: Dict[Tuple[int, int], int] = {}
+    notifications = []
+    for channel_id, channel_rows in by_channel.items():
+        user_ids = {user_id for row in channel_rows for user_id in row.get("mentions") or []}
+        role_ids = {role_id for row in channel_rows for role_id in row.get("role_mentions") or []}
+        conditions = []
+        if user_ids:
+            conditions.append(models.ServerMember.user_id.in_(user_ids))
+        if role_ids:
+            conditions.append(models.ServerMember.role_id.in_(role_ids))
+        # Упоминать можно только участников сервера, которому принадлежит канал
+        members = db.query(models.ServerMember.user_id, models.ServerMember.role_id)\
+            .join(models.Channel, models.Channel.server_id == models.ServerMember.server_id)\
+            .filter(models.Channel.id == channel_id, or_(*conditions))\
+            .all()
+
+        for row in channel_rows:
+            mentioned = set(row.get("mentions") or [])
+            roles = set(row.get("role_mentions") or [])
+            targets = {
+                user_id for user_id, role_id in members
+                if user_id in mentioned or role_id in roles
+            }
+            targets.discard(row["author_id"])
+            mention_rows.extend(
+                {"user_id": user_id, "message_id": row["id"], "channel_id": channel_id}
+                for user_id in targets
+            )
+            targets -= already_mentioned or set()
+            for user_id in targets:
+                counters[(user_id, channel_id)] = counters.get((user_id, channel_id), 0) + 1
+            if targets:
+                notifications.append((targets, {
+                    "type": "mention",
+                    "message_id": row["id"],
+                    "channel_id": channel_id,
+                    "author_id": row["author_id"],
+                    "content": row["content"]
+                }))
+
+    if mention_rows:
+        db.execute(_insert_ignore(db, models.MessageMention.__table__), mention_rows)
+    if counters:
+        table = models.ReadState.__table__
+        stmt = _dialect_insert(db, table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.channel_id],
+            set_={"mention_count": table.c.mention_count + stmt.excluded.mention_count}
+        )
+        db.execute(stmt, [
+            {"user_id": user_id, "channel_id": channel_id, "last_read_message_id": 0, "mention_count": count}
+            for (user_id, channel_id), count in counters.items()
+        ])
+
+    def notify():
+        for user_ids, event in notifications:
+            notification_manager.notify(user_ids, event)
+    if notifications:
+        run_after_commit(db, notify)
+
+def get_user_mentions(db: Session, user_id: int, before: Optional[int] = None, limit: int = 50):
+    query = db.query(models.Message)\
+        .join(models.MessageMention, models.MessageMention.message_id == models.Message.id)\
+        .filter(models.MessageMention.user_id == user_id)
+    if before is not None:
+        query = query.filter(models.MessageMention.message_id < before)
+    return query.order_by(models.MessageMention.message_id.desc()).limit(limit).all()
+
+def get_pending_mentions(db: Session, user_id: int, after: int):
+    """
+    Number and newest id of mentions of a user newer than `after`.
+    """
+    count, latest = db.query(func.count(), func.max(models.MessageMention.message_id))\
+        .filter(
+            models.MessageMention.user_id == user_id,
+            models.MessageMention.message_id > after
+        ).one()
+    return count, latest
+
+# Read state operations
+def get_latest_message_ids(db: Session, channel_ids: Set[int]) -> Dict[int, int]:
+    """
+    Newest message id of each channel, archived messages included (0 if none).
+    """
+    live = dict(db.query(models.Message.channel_id, func.max(models.Message.id))
+                .filter(models.Message.channel_id.in_(channel_ids))
+                .group_by(models.Message.channel_id).all())
+    archived = dict(db.query(models.ArchiveBlock.channel_id, func.max(models.ArchiveBlock.max_message_id))
+                    .filter(models.ArchiveBlock.channel_id.in_(channel_ids))
+                    .group_by(models.ArchiveBlock.channel_id).all())
+    return {
+        channel_id: max(live.get(channel_id) or 0, archived.get(channel_id) or 0)
+        for channel_id in channel_ids
+    }
+
+def save_read_states(db: Session, acks: Dict[Tuple[int, int], int]):
+    """
+    Move read watermarks forward for a batch of (user_id, channel_id) pairs
+    and recount their unread mentions. Watermarks are capped at the
+    channel's latest message. The caller commits.
+    """
+    latest = get_latest_message_ids(db, {channel_id for _, channel_id in acks})
+    acks = {
+        key: min(message_id, latest[key[1]])
+        for key, message_id in acks.items() if latest[key[1]] > 0
+    }
+    if not acks:
+        return
+    table = models.ReadState.__table__
+    stmt = _dialect_insert(db, table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.channel_id],
+        set_={"last_read_message_id": case(
+            (stmt.excluded.last_read_message_id > table.c.last_read_message_id, stmt.excluded.last_read_message_id),
+            else_=table.c.last_read_message_id
+        )}
+    )
+    db.execute(stmt, [
+        {"user_id": user_id, "channel_id": channel_id, "last_read_message_id": message_id, "mention_count": 0}
+        for (user_id, channel_id), message_id in acks.items()
+    ])
+
+    mentions = models.MessageMention.__table__
+    remaining = select(func.count())\
+        .where(
+            mentions.c.user_id == table.c.user_id,
+            mentions.c.channel_id == table.c.channel_id,
+            mentions.c.message_id > table.c.last_read_message_id
+        )\
+        .scalar_subquery()
     db.execute(
-        models.message_reactions.insert().values(
+        table.update()
+        .where(table.c.user_id == bindparam("ack_user_id"), table.c.channel_id == bindparam("ack_channel_id"))
+        .values(mention_count=remaining),
+        [{"ack_user_id": user_id, "ack_channel_id": channel_id} for user_id, channel_id in acks]
+    )
+
+def get_server_channels_with_read_state(db: Session, server_id: int, user_id: int):
+    """
+    Channels of a server with the user's read watermark, unread message count
+    and unread mention count, all in one query.
+    """
+    watermark = func.coalesce(models.ReadState.last_read_message_id, 0)
+    unread = select(func.count(models.Message.id))\
+        .where(models.Message.channel_id == models.Channel.id, models.Message.id > watermark)\
+        .correlate(models.Channel, models.ReadState)\
+        .scalar_subquery()
+    rows = db.query(models.Channel, watermark, func.coalesce(models.ReadState.mention_count, 0), unread)\
+        .outerjoin(models.ReadState, and_(
+            models.ReadState.channel_id == models.Channel.id,
+            models.ReadState.user_id == user_id
+        ))\
+        .filter(models.Channel.server_id == server_id)\
+        .order_by(models.Channel.position)\
+        .all()
+    channels = []
+    for channel, last_read, mention_count, unread_count in rows:
+        channel.last_read_message_id = last_read
+        channel.mention_count = mention_count
+        channel.unread_count = unread_count
+        channels.append(channel)
+    return channels
+
+def _dialect_insert(db: Session, table):
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(table)
+
+def _insert_ignore(db: Session, table):
+    """
+    INSERT that silently skips rows violating a unique constraint.
+    """
+    return _dialect_insert(db, table).on_conflict_do_nothing()
+
+def get_message_reactors(db: Session, message_ids: List[int]) -> Dict[int, Dict[str, set]]:
+    """
+    Users behind every reaction on the given messages, in one query:
+    {message_id: {emoji: {user_id, ...}}}.
+    """
+    reactors: Dict[int, Dict[str, set]] = {}
+    if not message_ids:
+        return reactors
+    rows = db.execute(
+        models.message_reactions.select().where(models.message_reactions.c.message_id.in_(message_ids))
+    )
+    for message_id, user_id, emoji in rows:
+        reactors.setdefault(message_id, {}).setdefault(emoji, set()).add(user_id)
+    return reactors
+
+def attach_reaction_counts(db: Session, messages: List[models.Message], user_id: Optional[int] = None):
+    """
+    Fill `reaction_counts` on a page of messages with a single grouped query,
+    so rendering a page costs the same number of queries regardless of size.
+    """
+    live = [message for message in messages if not getattr(message, "is_archived", False)]
+    if not live:
+        return messages
+    table = models.message_reactions
+    rows = db.query(
+        table.c.message_id,
+        table.c.emoji,
+        func.count(),
+        func.max(case((table.c.user_id == user_id, 1), else_=0))
+    )\
+        .filter(table.c.message_id.in_([message.id for message in live]))\
+        .group_by(table.c.message_id, table.c.emoji)\
+        .order_by(table.c.message_id, table.c.emoji)\
+        .all()
+    counts: Dict[int, List[Dict[str, Any]]] = {}
+    for message_id, emoji, count, me in rows:
+        counts.setdefault(message_id, []).append({"emoji": emoji, "count": count, "me": bool(me)})
+    for message in live:
+        message.reaction_counts = counts.get(message.id, [])
+    return messages
+
+def add_message_reaction(db: Session, message_id: int, user_id: int, emoji: str, channel_id: Optional[int] = None):
+    db.execute(
+        _insert_ignore(db, models.message_reactions).values(
             message_id=message_id,
             user_id=user_id,
             emoji=emoji
         )
     )
-    db.commit()
+    if channel_id is not None:
+        run_after_commit(db, lambda: message_cache.add_reaction(message_id, channel_id, user_id, emoji))
+    else:
+        run_after_commit(db, lambda: message_cache.remove_message(message_id))
     return {"message": "Reaction added successfully"}
 
-def remove_message_reaction(db: Session, message_id: int, user_id: int, emoji: str):
+def remove_message_reaction(db: Session, message_id: int, user_id: int, emoji: str, channel_id: Optional[int] = None):
     db.execute(
         models.message_reactions.delete().where(
             and_(
@@ -293,22 +760,20 @@ def remove_message_reaction(db: Session, message_id: int, user_id: int, emoji: s
             )
         )
     )
-    db.commit()
+    if channel_id is not None:
+        run_after_commit(db, lambda: message_cache.remove_reaction(message_id, channel_id, user_id, emoji))
+    else:
+        run_after_commit(db, lambda: message_cache.remove_message(message_id))
     return {"message": "Reaction removed successfully"}
 
 def create_audit_log(db: Session, server_id: int, user_id: int, action: str, target_type: str, target_id: int, changes: Dict[str, Any]):
-    db_log = models.AuditLog(
-        server_id=server_id,
-        user_id=user_id,
-        action=action,
-        target_type=target_type,
-        target_id=target_id,
-        changes=changes
-    )
-    db.add(db_log)
-    db.commit()
-    db.refresh(db_log)
-    return db_log
+    """
+    Queue an audit log entry. It reaches the event sink only if the
+    request's transaction commits, so rolled back actions are not logged.
+    """
+    run_after_commit(db, lambda: event_sink.add_audit_log(
+        server_id, user_id, action, target_type, target_id, changes
+    ))
 
 def get_server_audit_logs(db: Session, server_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.AuditLog)\
@@ -316,9 +781,15 @@ def get_server_audit_logs(db: Session, server_id: int, skip: int = 0, limit: int
         .order_by(models.AuditLog.created_at.desc())\
         .offset(skip).limit(limit).all()
 
+def get_server_audit_logs_after(db: Session, server_id: int, after_id: int, limit: int = 500):
+    return db.query(models.AuditLog)\
+        .filter(models.AuditLog.server_id == server_id, models.AuditLog.id > after_id)\
+        .order_by(models.AuditLog.id)\
+        .limit(limit).all()
+
 # Media operations
 def get_media(db: Session, media_id: int):
-    return db.query(models.Media).filter(models.Media.id == media_id).first()
+    return db.get(models.Media, media_id)
 
 def get_channel_media(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.Media)\
@@ -333,8 +804,7 @@ def create_media(db: Session, media: schemas.MediaCreate, uploaded_by_id: int, c
         channel_id=channel_id
     )
     db.add(db_media)
-    db.commit()
-    db.refresh(db_media)
+    db.flush()
     return db_media
 
 def delete_media(db: Session, media_id: int):
@@ -342,13 +812,67 @@ def delete_media(db: Session, media_id: int):
     if not db_media:
         raise HTTPException(status_code=404, detail="Media not found")
     
+    if db_media.sha256 is not None:
+        release_blob(db, db_media.sha256)
     db.delete(db_media)
-    db.commit()
+    db.flush()
     return {"message": "Media deleted successfully"}
 
+def get_blob(db: Session, sha256: str):
+    return db.get(models.Blob, sha256)
+
+def _delete_channel_media(db: Session, channel_ids: List[int]):
+    # Медиа удаляются вместе с каналами, их ссылки на файлы освобождаются
+    if not channel_ids:
+        return
+    references = db.query(models.Media.sha256, func.count())\
+        .filter(models.Media.channel_id.in_(channel_ids), models.Media.sha256.isnot(None))\
+        .group_by(models.Media.sha256).all()
+    for sha256, count in references:
+        release_blob(db, sha256, count)
+    db.query(models.Media)\
+        .filter(models.Media.channel_id.in_(channel_ids))\
+        .delete(synchronize_session=False)
+
+def get_blob_channel_ids(db: Session, sha256: str) -> List[int]:
+    return [channel_id for channel_id, in db.query(models.Media.channel_id)
+            .filter(models.Media.sha256 == sha256)
+            .distinct().all()]
+
+def release_blob(db: Session, sha256: str, count: int = 1):
+    # Последняя ссылка запоминает время, от него отсчитывается срок сборщика
+    db.query(models.Blob)\
+        .filter(models.Blob.sha256 == sha256)\
+        .update({
+            models.Blob.ref_count: models.Blob.ref_count - count,
+            models.Blob.released_at: case(
+                (models.Blob.ref_count <= count, datetime.utcnow()),
+                else_=models.Blob.released_at
+            )
+        }, synchronize_session=False)
+
+def delete_unreferenced_blobs(db: Session, grace_seconds: int, limit: int) -> List[str]:
+    """
+    Delete up to `limit` blob rows that have had no references for
+    `grace_seconds`, returning their hashes. Rows referenced again in the
+    meantime are kept. Commit only after their files are removed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    candidates = [sha256 for sha256, in db.query(models.Blob.sha256)
+                  .filter(models.Blob.ref_count <= 0, models.Blob.released_at < cutoff)
+                  .limit(limit).all()]
+    if not candidates:
+        return []
+    # DELETE переводит сессию на писателя, дальше читаем уже после блокировки
+    db.query(models.Blob)\
+        .filter(models.Blob.sha256.in_(candidates), models.Blob.ref_count <= 0)\
+        .delete(synchronize_session=False)
+    kept = {sha256 for sha256, in db.query(models.Blob.sha256).filter(models.Blob.sha256.in_(candidates)).all()}
+    return [sha256 for sha256 in candidates if sha256 not in kept]
+
 # Game operations
 def get_game_session(db: Session, game_id: int):
-    return db.query(models.GameSession).filter(models.GameSession.id == game_id).first()
+    return db.get(models.GameSession, game_id)
 
 def get_channel_games(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.GameSession)\
@@ -364,8 +888,7 @@ def create_game_session(db: Session, game: schemas.GameSessionCreate, created_by
         status="active"
     )
     db.add(db_game)
-    db.commit()
-    db.refresh(db_game)
+    db.flush()
     return db_game
 
 def update_game_session(db: Session, game_id: int, game: Dict[str, Any]):
@@ -376,8 +899,7 @@ def update_game_session(db: Session, game_id: int, game: Dict[str, Any]):
     for field, value in game.items():
         setattr(db_game, field, value)
     
-    db.commit()
-    db.refresh(db_game)
+    db.flush()
     return db_game
 
 def add_game_player(db: Session, game_id: int, user_id: int):
@@ -387,8 +909,7 @@ def add_game_player(db: Session, game_id: int, user_id: int):
         status="active"
     )
     db.add(db_player)
-    db.commit()
-    db.refresh(db_player)
+    db.flush()
     return db_player
 
 def update_game_player(db: Session, game_id: int, user_id: int, player_data: Dict[str, Any]):
@@ -404,8 +925,7 @@ def update_game_player(db: Session, game_id: int, user_id: int, player_data: Dic
     for field, value in player_data.items():
         setattr(db_player, field, value)
     
-    db.commit()
-    db.refresh(db_player)
+    db.flush()
     return db_player
 
 # Music operations
@@ -425,15 +945,15 @@ def add_to_music_queue(db: Session, music: schemas.MusicQueueCreate, added_by_id
     position = (last_position.position + 1) if last_position else 0
     
     db_music = models.MusicQueue(
-        **music.dict(),
+        **music.dict(exclude={"position", "status"}),
         added_by_id=added_by_id,
         channel_id=channel_id,
         position=position,
         status="queued"
     )
     db.add(db_music)
-    db.commit()
-    db.refresh(db_music)
+    db.flush()
+    resource_versions.bump(db, "music", channel_id)
     return db_music
 
 def update_music_status(db: Session, music_id: int, status: str):
@@ -442,8 +962,8 @@ def update_music_status(db: Session, music_id: int, status: str):
         raise HTTPException(status_code=404, detail="Music not found")
     
     db_music.status = status
-    db.commit()
-    db.refresh(db_music)
+    db.flush()
+    resource_versions.bump(db, "music", db_music.channel_id)
     return db_music
 
 def remove_from_music_queue(db: Session, music_id: int):
@@ -452,7 +972,8 @@ def remove_from_music_queue(db: Session, music_id: int):
         raise HTTPException(status_code=404, detail="Music not found")
     
     db.delete(db_music)
-    db.commit()
+    db.flush()
+    resource_versions.bump(db, "music", db_music.channel_id)
     return {"message": "Music removed from queue successfully"}
 
 def create_invite_code(db: Session, server_id: int, user_id: int) -> models.InviteCode:
@@ -467,8 +988,7 @@ def create_invite_code(db: Session, server_id: int, user_id: int) -> models.Invi
         expires_at=datetime.utcnow() + timedelta(days=7)  # Expires in 7 days
     )
     db.add(db_invite)
-    db.commit()
-    db.refresh(db_invite)
+    db.flush()
     return db_invite
 
 def get_server_by_invite_code(db: Session, invite_code: str) -> Optional[models.Server]:
@@ -483,10 +1003,7 @@ def get_server_by_invite_code(db: Session, invite_code: str) -> Optional[models.
     return invite.server
 
 def is_user_server_member(db: Session, user_id: int, server_id: int) -> bool:
-    return db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user_id,
-        models.ServerMember.server_id == server_id
-    ).first() is not None
+    return membership_cache.get(db, user_id, server_id) is not None
 
 def add_user_to_server(db: Session, user_id: int, server_id: int) -> models.ServerMember:
     # Check if user is already a member
@@ -503,8 +1020,8 @@ def add_user_to_server(db: Session, user_id: int, server_id: int) -> models.Serv
         role_type=models.RoleType.MEMBER
     )
     db.add(db_member)
-    db.commit()
-    db.refresh(db_member)
+    db.flush()
+    _invalidate_membership(db, server_id, user_id)
     return db_member
 
 def update_user_credentials(db: Session, user_id: int, new_username: str, new_password: str):
@@ -512,6 +1029,7 @@ def update_user_credentials(db: Session, user_id: int, new_username: str, new_pa
     Update both username and password for a user.
     """
     from auth import get_password_hash
+    from password_pool import password_pool
     
     print(f"Updating credentials for user {user_id}")
     print(f"New username: {new_username}")
@@ -525,16 +1043,13 @@ def update_user_credentials(db: Session, user_id: int, new_username: str, new_pa
     db_user.username = new_username
     
     # Update password
-    hashed_password = get_password_hash(new_password)
+    hashed_password = password_pool.run(get_password_hash, new_password)
     print(f"Generated new hash: {hashed_password}")
     
-    # Verify the new hash immediately
-    from auth import verify_password
-    verification_result = verify_password(new_password, hashed_password)
-    print(f"Verification of new hash: {verification_result}")
-    
     db_user.hashed_password = hashed_password
+    # Смена пароля отзывает выданные токены
+    db_user.token_version = (db_user.token_version or 0) + 1
     
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
+    _invalidate_user(db, db_user)
     return db_user 
\ No newline at end of file
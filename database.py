@@ -1,29 +1,206 @@
-from sqlalchemy import create_engine
+from fastapi import Request
+from fastapi.routing import APIRoute
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.schema import CreateColumn
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
 import config
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL: читатели не блокируют писателя и наоборот
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+def _set_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def create_engines(url, single_writer=True):
+    """
+    Create the (write, read) engine pair for `url`.
+    For SQLite with `single_writer` all writes share one connection, so
+    writers queue on the pool instead of failing with "database is locked",
+    and reads use a separate read-only pool. Otherwise the read engine is
+    None and everything goes through one pooled engine.
+    """
+    if make_url(url).get_backend_name() != "sqlite" or not single_writer:
+        return create_engine(
+            url,
+            pool_pre_ping=True,  # Enable connection health checks
+            pool_size=5,  # Set connection pool size
+            max_overflow=10  # Allow up to 10 connections beyond pool_size
+        ), None
+
+    write_engine = create_engine(
+        url,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=config.SQLITE_WRITE_TIMEOUT
+    )
+    read_engine = create_engine(
+        url,
+        pool_size=config.SQLITE_READ_POOL_SIZE,
+        max_overflow=10
+    )
+    event.listen(write_engine, "connect", _set_sqlite_pragmas)
+    event.listen(read_engine, "connect", _set_sqlite_pragmas)
+    event.listen(read_engine, "connect", _set_query_only)
+    return write_engine, read_engine
+
+class RoutingSession(Session):
+    """
+    Session that reads through `read_bind` and writes through its main bind.
+    Once a transaction has written it stays on the writer, so it can read
+    its own uncommitted rows.
+    """
+    def __init__(self, *args, read_bind=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_bind = read_bind
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.read_bind is None:
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        if self._flushing or isinstance(clause, (UpdateBase, TextClause)):
+            self.info["writing"] = True
+        if self.info.get("writing"):
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        return self.read_bind
+
 # Create engine with proper configuration
-engine = create_engine(
-    config.DATABASE_URL,
-    pool_pre_ping=True,  # Enable connection health checks
-    pool_size=5,  # Set connection pool size
-    max_overflow=10  # Allow up to 10 connections beyond pool_size
-)
+engine, read_engine = create_engines(config.DATABASE_URL, config.SQLITE_SINGLE_WRITER)
 
-# Create session factory
+# Create session factory. Objects stay loaded after commit, so after-commit
+# callbacks and response code can read them without another query
 SessionLocal = sessionmaker(
+    class_=RoutingSession,
     autocommit=False,
     autoflush=False,
-    bind=engine
+    expire_on_commit=False,
+    bind=engine,
+    read_bind=read_engine
+)
+
+# Async engine for async def handlers, so DB calls don't block the event loop
+async_engine = create_async_engine(
+    config.ASYNC_DATABASE_URL,
+    pool_pre_ping=True
+)
+
+if make_url(config.ASYNC_DATABASE_URL).get_backend_name() == "sqlite":
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    autoflush=False,
+    expire_on_commit=False
 )
 
 Base = declarative_base()
 
-# Dependency
-def get_db():
+def run_after_commit(db, callback):
+    """
+    Run `callback` once the session's current transaction has committed.
+    Callbacks are discarded if the transaction rolls back.
+    """
+    db.info.setdefault("after_commit", []).append(callback)
+
+@event.listens_for(SessionLocal, "after_commit")
+def _run_after_commit_callbacks(session):
+    for callback in session.info.pop("after_commit", []):
+        try:
+            callback()
+        except Exception as e:
+            print(f"Error in after-commit callback: {e}")
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_after_commit_callbacks(session):
+    session.info.pop("after_commit", None)
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def _reset_write_routing(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("writing", None)
+
+# Таблицы, где дубликаты заведомо мусор и удаляются перед созданием уникального индекса
+_DEDUPLICATE_BEFORE_UNIQUE = {"message_reactions"}
+
+def upgrade_schema(bind=engine):
+    """
+    Bring existing tables up to date with the models.
+    create_all() only creates missing tables, so columns and indexes added
+    to models later are created here. New columns must be nullable or have
+    a server_default. A new unique index fails on existing duplicates,
+    except on tables listed in _DEDUPLICATE_BEFORE_UNIQUE.
+    """
+    with bind.begin() as conn:
+        # Инспектируем через то же соединение: у SQLite-писателя оно единственное
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    ddl = CreateColumn(column).compile(dialect=bind.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                    print(f"Added column {table.name}.{column.name}")
+
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.unique and table.name in _DEDUPLICATE_BEFORE_UNIQUE and bind.dialect.name == "sqlite":
+                    # Повторные реакции раньше вставлялись без проверки, без их
+                    # удаления уникальный индекс не создастся
+                    columns = ", ".join(column.name for column in index.columns)
+                    removed = conn.execute(text(
+                        f"DELETE FROM {table.name} WHERE rowid NOT IN "
+                        f"(SELECT MIN(rowid) FROM {table.name} GROUP BY {columns})"
+                    )).rowcount
+                    print(f"Removed {removed} duplicate rows from {table.name} before creating {index.name}")
+                index.create(conn)
+                print(f"Created index {index.name}")
+
+# Dependency. One session per request: FastAPI caches the dependency, so
+# auth and the route share it (and its identity map)
+def get_db(request: Request):
     db = SessionLocal()
+    request.state.db = db
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+class UnitOfWorkRoute(APIRoute):
+    """
+    Route that commits the request's session once, after the endpoint has
+    returned. CRUD functions only flush, so every change of a request,
+    including its audit log entry, is committed atomically. If the
+    endpoint raises, nothing is committed.
+    """
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def unit_of_work_handler(request: Request):
+            response = await handler(request)
+            db = getattr(request.state, "db", None)
+            if db is not None and db.in_transaction():
+                await run_in_threadpool(db.commit)
+            return response
+
+        return unit_of_work_handler
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
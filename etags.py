@@ -0,0 +1,83 @@
+import secrets
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, Response
+
+import config
+from compression import strip_encoding_etag
+from database import run_after_commit
+from membership_cache import bump_version, read_version
+
+# Версии для условных GET.
+# Для редко меняющихся данных (сервер, его роли, музыкальная очередь канала)
+# в памяти хранится счетчик, который увеличивают функции crud, меняющие эти
+# данные. ETag строится из счетчика, поэтому If-None-Match проверяется без
+# запроса к БД и сериализации. Изменения из других процессов видны через
+# общую версию "etags" в cache_versions: раз в ETAG_VERSION_CHECK_MS она
+# сверяется, и при расхождении меняется эпоха, то есть все ETag этого процесса.
+
+_VERSION_KEY = "etags"
+
+class ResourceVersions:
+    def __init__(self, check_interval_ms: int):
+        self.check_interval = check_interval_ms / 1000
+        self.versions: Dict[Tuple[str, int], int] = {}
+        self.epoch = secrets.token_hex(4)
+        self.shared_version: Optional[int] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def etag(self, db, kind: str, resource_id: int) -> str:
+        if time.monotonic() - self.checked_at >= self.check_interval:
+            self._apply_shared_version(read_version(db, _VERSION_KEY))
+        with self.lock:
+            return f'"{self.epoch}-{kind}-{resource_id}-{self.versions.get((kind, resource_id), 0)}"'
+
+    def bump(self, db, kind: str, resource_id: int) -> None:
+        """
+        Mark a resource as changed by the caller's transaction. The local
+        counter moves after commit; other processes notice the shared version.
+        """
+        version = bump_version(db, _VERSION_KEY)
+        run_after_commit(db, lambda: self._bump_local(kind, resource_id, version))
+
+    def _bump_local(self, kind: str, resource_id: int, version: int) -> None:
+        key = (kind, resource_id)
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            if self.shared_version is not None and version == self.shared_version + 1:
+                self.shared_version = version
+            else:
+                # Между нашими изменениями были чужие
+                self.epoch = secrets.token_hex(4)
+                self.shared_version = version
+
+    def _apply_shared_version(self, version: int) -> None:
+        with self.lock:
+            self.checked_at = time.monotonic()
+            if self.shared_version is not None and version != self.shared_version:
+                self.epoch = secrets.token_hex(4)
+            self.shared_version = version
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """
+    304 response if the client already has this version, else None.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # Сжатые представления отличаются суффиксом ETag
+        if tag == "*" or strip_encoding_etag(tag) == etag:
+            return Response(status_code=304, headers=etag_headers(etag if tag == "*" else tag))
+    return None
+
+def etag_headers(etag: str) -> Dict[str, str]:
+    # Ответы зависят от пользователя, поэтому кэш только приватный и с перепроверкой
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+# Create a global instance
+resource_versions = ResourceVersions(config.ETAG_VERSION_CHECK_MS)
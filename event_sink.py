@@ -0,0 +1,145 @@
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+import config
+import models
+from database import SessionLocal
+
+# Журнал событий: записи аудита и попыток входа.
+# Записи только добавляются, поэтому запрос не ждет их коммита: они копятся в
+# ограниченной очереди и пишутся многострочными INSERT раз в
+# EVENT_SINK_INTERVAL_MS или по EVENT_SINK_MAX_ROWS строк. Чтения журнала
+# вызывают flush(), чтобы видеть собственные записи. Из async-обработчиков
+# записи добавляются с block=False: цикл событий не ждет места в очереди.
+
+_TABLES = {
+    "audit": models.AuditLog,
+    "login": models.LoginHistory
+}
+
+class EventSink:
+    def __init__(self, max_rows: int, interval_ms: int, max_queue: int, overflow: str):
+        self.max_rows = max_rows
+        self.interval = interval_ms / 1000
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.pending: List[Tuple[str, Dict[str, Any]]] = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+    def add_audit_log(self, server_id: int, user_id: int, action: str, target_type: str,
+                      target_id: int, changes: Dict[str, Any], block: bool = True) -> None:
+        self._put("audit", {
+            "server_id": server_id,
+            "user_id": user_id,
+            "action": action,
+            "target_type": target_type,
+            "target_id": target_id,
+            "changes": changes,
+            "created_at": datetime.utcnow()
+        }, block)
+
+    def add_login_attempt(self, ip_address: str, success: bool, user_id: Optional[int] = None,
+                          user_agent: Optional[str] = None, block: bool = True) -> None:
+        self._put("login", {
+            "user_id": user_id,
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "success": success,
+            "login_time": datetime.utcnow()
+        }, block)
+
+    def flush(self) -> None:
+        """
+        Write everything queued so far, one multi-row INSERT per table.
+        If the worker is writing a batch, waits for it to finish, so after
+        flush() returns every earlier event is committed.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.not_full.notify_all()
+            if batch:
+                self._write(batch)
+
+    def stop(self) -> None:
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def _write(self, batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        rows: Dict[str, List[Dict[str, Any]]] = {}
+        for kind, values in batch:
+            rows.setdefault(kind, []).append(values)
+        db = SessionLocal()
+        try:
+            for kind, values in rows.items():
+                db.execute(insert(_TABLES[kind]), values)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(batch) == 1:
+                with self.lock:
+                    self.dropped += 1
+                print(f"Dropped {batch[0][0]} event: {e} ({self.dropped} dropped so far)")
+                return
+            # Одна плохая строка не должна терять или задерживать остальные
+            print(f"Writing {len(batch)} log events failed, retrying one by one: {e}")
+            for item in batch:
+                self._write([item])
+        finally:
+            db.close()
+
+    def _put(self, kind: str, values: Dict[str, Any], block: bool = True) -> None:
+        self._ensure_started()
+        with self.lock:
+            if len(self.pending) >= self.max_queue:
+                self.wakeup.set()
+                if self.overflow == "block" and block:
+                    # Ждем, пока воркер освободит место
+                    self.not_full.wait_for(
+                        lambda: len(self.pending) < self.max_queue,
+                        timeout=config.EVENT_SINK_BLOCK_TIMEOUT
+                    )
+                if len(self.pending) >= self.max_queue:
+                    self.dropped += 1
+                    print(f"Event sink is full, dropped {kind} event ({self.dropped} dropped so far)")
+                    return
+            self.pending.append((kind, values))
+            if len(self.pending) >= self.max_rows:
+                self.wakeup.set()
+
+    def _ensure_started(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.running = True
+                self.wakeup.clear()
+                self.thread = threading.Thread(target=self._run, name="event-sink", daemon=True)
+                self.thread.start()
+
+    def _run(self) -> None:
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+# Create a global instance
+event_sink = EventSink(
+    config.EVENT_SINK_MAX_ROWS,
+    config.EVENT_SINK_INTERVAL_MS,
+    config.EVENT_SINK_MAX_QUEUE,
+    config.EVENT_SINK_OVERFLOW
+)
@@ -0,0 +1,84 @@
+import zlib
+from typing import Iterator, Optional
+
+from fastapi.responses import StreamingResponse
+
+import archive
+import config
+import crud
+import schemas
+from database import SessionLocal
+
+# Потоковая выгрузка истории в NDJSON.
+# Данные читаются keyset-пачками по EXPORT_BATCH_SIZE строк в отдельной сессии,
+# поэтому память не зависит от размера канала, а первые байты уходят сразу.
+
+def _gzip_stream(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_channel_export(channel_id: int, user_id: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Every message of a channel, oldest first: archived blocks, then live rows.
+    """
+    db = SessionLocal()
+    try:
+        last_id = 0
+        lines = []
+        for row in archive.iter_archived_messages(db, channel_id, newest_first=False):
+            lines.append(archive.to_message(row, user_id).model_dump_json().encode() + b"\n")
+            last_id = row["id"]
+            if len(lines) >= config.EXPORT_BATCH_SIZE:
+                yield b"".join(lines)
+                lines = []
+        if lines:
+            yield b"".join(lines)
+
+        while True:
+            messages = crud.get_channel_messages_after(db, channel_id, last_id, config.EXPORT_BATCH_SIZE)
+            if not messages:
+                break
+            crud.attach_reaction_counts(db, messages, user_id)
+            yield b"".join(
+                schemas.Message.model_validate(message).model_dump_json().encode() + b"\n"
+                for message in messages
+            )
+            last_id = messages[-1].id
+            # Не держим уже выгруженные объекты в identity map
+            db.expunge_all()
+    finally:
+        db.close()
+
+def iter_audit_log_export(server_id: int) -> Iterator[bytes]:
+    db = SessionLocal()
+    try:
+        last_id = 0
+        while True:
+            logs = crud.get_server_audit_logs_after(db, server_id, last_id, config.EXPORT_BATCH_SIZE)
+            if not logs:
+                break
+            yield b"".join(
+                schemas.AuditLog.model_validate(log).model_dump_json().encode() + b"\n"
+                for log in logs
+            )
+            last_id = logs[-1].id
+            db.expunge_all()
+    finally:
+        db.close()
+
+def export_response(chunks: Iterator[bytes], filename: str, gzip: bool = False) -> StreamingResponse:
+    if gzip:
+        return StreamingResponse(
+            _gzip_stream(chunks),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'}
+        )
+    return StreamingResponse(
+        chunks,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
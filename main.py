@@ -1,7 +1,9 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, Path, Query, status, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict, Any
 import uvicorn
 from datetime import datetime, timedelta
@@ -10,14 +12,37 @@ from jose import JWTError, jwt
 import socket
 import base64
 import websockets
+import os
+import re
+import time
+from starlette.concurrency import run_in_threadpool
 
 from database import *
 import models as models
 import schemas as schemas
 import auth as auth
 import crud as crud
+import async_crud
 import config
 from audio_handler import audio_handler
+from message_cache import message_cache
+from message_writer import message_writer
+from notifications import notification_manager
+from read_states import read_state_writer
+from event_sink import event_sink
+from membership_cache import Membership, membership_cache
+from user_cache import UserSnapshot, user_cache
+from password_pool import password_pool
+from rate_limiter import login_rate_limiter
+from token_cache import token_cache
+from serialization import list_response
+from etags import etag_headers, not_modified, resource_versions
+from compression import CompressionMiddleware, choose_encoding
+from permissions import Permission
+import export
+from query_stats import QueryStatsMiddleware, query_budget
+from uploads import receive_upload
+from blob_store import blob_store
 
 # Import User model explicitly
 from models import User, Channel, ServerMember
@@ -26,11 +51,14 @@ from models import User, Channel, ServerMember
 try:
     # Only create tables if they don't exist
     models.Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
     print("Database tables created successfully")
 except Exception as e:
     print(f"Error creating database tables: {e}")
 
 app = FastAPI(title="Dump API")
+# Один коммит в конце каждого запроса
+app.router.route_class = UnitOfWorkRoute
 
 # Настройка CORS
 app.add_middleware(
@@ -56,6 +84,12 @@ app.add_middleware(
     max_age=3600
 )
 
+# Число запросов к БД и время в заголовке Server-Timing
+app.add_middleware(QueryStatsMiddleware)
+
+# Сжатие больших текстовых ответов (gzip/brotli по Accept-Encoding)
+app.add_middleware(CompressionMiddleware)
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
@@ -208,6 +242,19 @@ class VoiceChannelManager:
 
 voice_manager = VoiceChannelManager()
 
+@app.on_event("startup")
+def start_blob_collector():
+    blob_store.start()
+
+@app.on_event("shutdown")
+def shutdown_background_writers():
+    # Дописываем сообщения и отметки о прочтении, оставшиеся в очереди
+    message_writer.stop()
+    read_state_writer.stop()
+    event_sink.stop()
+    password_pool.shutdown()
+    blob_store.stop()
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
@@ -220,16 +267,51 @@ async def websocket_endpoint(websocket: WebSocket):
         manager.disconnect(websocket)
         await manager.broadcast("Client disconnected")
 
+@app.websocket("/ws/notifications")
+async def notifications_endpoint(websocket: WebSocket, token: str, since: Optional[int] = None):
+    try:
+        payload = token_cache.decode(token)
+        user_email = payload.get("sub")
+    except JWTError:
+        await websocket.close(code=4000, reason="Invalid token")
+        return
+
+    async with AsyncSessionLocal() as db:
+        user = await user_cache.get_async(db, user_email) if user_email else None
+        if not user or not auth.token_version_matches(payload, user):
+            await websocket.close(code=4000, reason="User not found")
+            return
+        user_id = user.id
+        # Упоминания, пришедшие пока пользователь был оффлайн, отдаем одной сводкой
+        pending = await async_crud.get_pending_mentions(db, user_id, since) if since is not None else None
+
+    await notification_manager.connect(websocket, user_id)
+    try:
+        if pending is not None:
+            count, latest = pending
+            await websocket.send_json({
+                "type": "mentions_summary",
+                "count": count,
+                "latest_message_id": latest
+            })
+        while True:
+            message = await websocket.receive_text()
+            if message == "ping":
+                await websocket.send_json({"type": "pong"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        notification_manager.disconnect(websocket, user_id)
+
 @app.websocket("/ws/voice/{channel_id}")
 async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: str):
     user = None
-    db = None
     try:
         print(f"[{datetime.now()}] WebSocket connection attempt for channel {channel_id}")
         
         # Decode token and get user
         try:
-            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+            payload = token_cache.decode(token)
             user_email = payload.get("sub")
             if not user_email:
                 print(f"[{datetime.now()}] Invalid token - no user email")
@@ -239,17 +321,28 @@ async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: s
             print(f"[{datetime.now()}] Token expired, attempting to refresh")
             # Try to refresh the token
             try:
-                db = SessionLocal()
-                user = db.query(User).filter(User.email == payload.get("sub")).first()
+                # Подпись проверена, не проверяем только срок действия
+                payload = token_cache.decode(token, verify_exp=False)
+                # Обновляем только недавно истекшие токены, иначе срок действия ничего не значит
+                expired_for = time.time() - payload.get("exp", 0)
+                if expired_for > config.ACCESS_TOKEN_EXPIRE_MINUTES * 60:
+                    print(f"[{datetime.now()}] Token expired too long ago to refresh")
+                    await websocket.close(code=4001, reason="Token expired")
+                    return
+                user_email = payload.get("sub")
+                async with AsyncSessionLocal() as db:
+                    user = await user_cache.get_async(db, user_email) if user_email else None
+                    if user and not auth.token_version_matches(payload, user):
+                        user = None
+                    if user:
+                        # Update last login
+                        await async_crud.update_last_login(db, user.id)
                 if user:
                     # Create new token
                     access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
                     new_token = auth.create_access_token(
-                        data={"sub": user.email}, expires_delta=access_token_expires
+                        data={"sub": user.email, "ver": user.token_version}, expires_delta=access_token_expires
                     )
-                    # Update last login
-                    user.last_login = datetime.now()
-                    db.commit()
                     # Send new token to client
                     await websocket.accept()
                     await websocket.send_json({
@@ -269,28 +362,25 @@ async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: s
             await websocket.close(code=4000, reason="Invalid token")
             return
 
-        # Get user from database
-        if not db:
-            db = SessionLocal()
         try:
-            user = db.query(User).filter(User.email == user_email).first()
-            if not user:
-                print(f"[{datetime.now()}] User not found for email: {user_email}")
-                await websocket.close(code=4000, reason="User not found")
-                return
+            # Get user from database. Lookups use the async session, which is
+            # released before the message loop so slow queries never stall relaying
+            async with AsyncSessionLocal() as db:
+                user = await user_cache.get_async(db, user_email)
+                if not user or not auth.token_version_matches(payload, user):
+                    print(f"[{datetime.now()}] User not found for email: {user_email}")
+                    await websocket.close(code=4000, reason="User not found")
+                    return
 
-            # Get channel and verify user is a member
-            channel = db.query(Channel).filter(Channel.id == channel_id).first()
-            if not channel:
-                print(f"[{datetime.now()}] Channel not found: {channel_id}")
-                await websocket.close(code=4000, reason="Channel not found")
-                return
+                # Get channel and verify user is a member
+                channel = await async_crud.get_channel(db, channel_id)
+                if not channel:
+                    print(f"[{datetime.now()}] Channel not found: {channel_id}")
+                    await websocket.close(code=4000, reason="Channel not found")
+                    return
 
-            # Check if user is a member of the server
-            membership = db.query(ServerMember).filter(
-                ServerMember.server_id == channel.server_id,
-                ServerMember.user_id == user.id
-            ).first()
+                # Check if user is a member of the server
+                membership = await membership_cache.get_async(db, user.id, channel.server_id)
             
             if not membership:
                 print(f"[{datetime.now()}] User {user.id} is not a member of server {channel.server_id}")
@@ -399,25 +489,26 @@ async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: s
         if user and channel_id:
             print(f"[{datetime.now()}] Cleaning up resources for user {user.username}")
             await voice_manager.disconnect_user(user.id)
-        if db:
-            db.close()
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 @app.post("/token")
 async def login_for_access_token(
     request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
+    user = None
+    user_agent = request.headers.get("user-agent")
+    # Лимит проверяется до любых запросов к БД и bcrypt
+    retry_after = await login_rate_limiter.check(request.client.host, form_data.username)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": str(retry_after)}
+        )
     try:
         # Get client IP
         client_ip = request.client.host
@@ -430,7 +521,7 @@ async def login_for_access_token(
         print(f"Password bytes: {[ord(c) for c in form_data.password]}")
 
         # Get user and verify password
-        user = crud.get_user_by_email(db, form_data.username)
+        user = await async_crud.get_user_by_email(db, form_data.username)
         if not user:
             print(f"User not found: {form_data.username}")
             raise HTTPException(
@@ -438,19 +529,24 @@ async def login_for_access_token(
                 detail="Incorrect email or password"
             )
 
-        if not auth.verify_password(form_data.password, user.hashed_password):
+        # bcrypt считается в отдельном пуле, цикл событий не блокируется
+        if not await password_pool.run_async(auth.verify_password, form_data.password, user.hashed_password):
             print(f"Invalid password for user: {form_data.username}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect email or password"
             )
 
+        if auth.password_needs_rehash(user.hashed_password):
+            password_pool.rehash_in_background(user.id, form_data.password, user.hashed_password)
+
         # Create access token
-        access_token = auth.create_access_token(data={"sub": user.email})
+        access_token = auth.create_access_token(data={"sub": user.email, "ver": user.token_version})
         print(f"Login successful for user: {form_data.username}")
 
         # Log successful attempt
-        crud.log_login_attempt(db, client_ip, True)
+        event_sink.add_login_attempt(client_ip, True, user_id=user.id, user_agent=user_agent, block=False)
+        await login_rate_limiter.record_success(form_data.username)
 
         return {
             "access_token": access_token,
@@ -463,12 +559,17 @@ async def login_for_access_token(
             }
         }
     except HTTPException as he:
-        # Log failed attempt
-        crud.log_login_attempt(db, request.client.host, False)
+        # Log failed attempt; a busy password pool is not a failed attempt.
+        # Неудачная попытка уже засчитана в check(), остальные возвращаем
+        if he.status_code != status.HTTP_429_TOO_MANY_REQUESTS:
+            event_sink.add_login_attempt(request.client.host, False, user_id=user and user.id, user_agent=user_agent, block=False)
+        if he.status_code != status.HTTP_401_UNAUTHORIZED:
+            await login_rate_limiter.release(form_data.username)
         raise he
     except Exception as e:
         print(f"Login error: {str(e)}")
-        crud.log_login_attempt(db, request.client.host, False)
+        event_sink.add_login_attempt(request.client.host, False, user_id=user and user.id, user_agent=user_agent, block=False)
+        await login_rate_limiter.release(form_data.username)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An error occurred during login"
@@ -476,19 +577,18 @@ async def login_for_access_token(
 
 @app.post("/token/refresh")
 async def refresh_token(
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
         # Create new access token
         access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = auth.create_access_token(
-            data={"sub": current_user.email}, expires_delta=access_token_expires
+            data={"sub": current_user.email, "ver": current_user.token_version}, expires_delta=access_token_expires
         )
         
         # Update last login time
-        current_user.last_login = datetime.now()
-        db.commit()
+        await async_crud.update_last_login(db, current_user.id)
         
         return {"access_token": access_token, "token_type": "bearer"}
     except Exception as e:
@@ -523,37 +623,72 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     return new_user
 
 @app.get("/users/me/", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
+@query_budget(1)
+def read_users_me(current_user: UserSnapshot = Depends(auth.get_current_user)):
     return current_user
 
 @app.put("/users/me/", response_model=schemas.User)
 def update_user_me(
     user: schemas.UserUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     return crud.update_user(db=db, user_id=current_user.id, user=user)
 
+@app.post("/users/me/revoke-tokens")
+def revoke_my_tokens(
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    crud.revoke_user_tokens(db=db, user_id=current_user.id)
+    return {"message": "All tokens revoked"}
+
+@app.delete("/users/me/", response_model=schemas.User)
+def deactivate_user_me(
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    return crud.deactivate_user(db=db, user_id=current_user.id)
+
 @app.get("/users/me/login-history/", response_model=List[schemas.LoginHistory])
 def read_login_history(
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 100
 ):
-    return crud.get_login_history(db=db, user_id=current_user.id, skip=skip, limit=limit)
+    # Записи о входе пишутся в фоне, дописываем их перед чтением
+    event_sink.flush()
+    return list_response(
+        schemas.LoginHistory, crud.get_login_history(db=db, user_id=current_user.id, skip=skip, limit=limit)
+    )
+
+@app.get("/users/me/mentions", response_model=schemas.MentionPage)
+def read_my_mentions(
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: Session = Depends(get_db),
+    before: Optional[int] = None,
+    limit: int = 50
+):
+    messages = crud.get_user_mentions(db=db, user_id=current_user.id, before=before, limit=limit)
+    crud.attach_reaction_counts(db, messages, current_user.id)
+    return {
+        "messages": messages,
+        "next_cursor": messages[-1].id if len(messages) == limit else None
+    }
 
 @app.post("/servers/", response_model=schemas.Server)
 def create_server(
     server: schemas.ServerCreate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     return crud.create_server(db=db, server=server, owner_id=current_user.id)
 
 @app.get("/servers/", response_model=List[schemas.Server])
+@query_budget(2)
 def read_servers(
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 100
@@ -561,29 +696,58 @@ def read_servers(
     return crud.get_user_servers(db=db, user_id=current_user.id)
 
 @app.get("/servers/{server_id}", response_model=schemas.Server)
+@query_budget(4)  # 304 на холодных кэшах: пользователь, две версии, владелец
 def read_server(
     server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    request: Request,
+    response: Response,
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
+    # ETag берется до запроса: если сервер изменится между ними, клиент
+    # получит старый ETag с новыми данными и просто перезапросит их позже
+    etag = resource_versions.etag(db, "server", server_id)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        # Существование сервера проверяется по кэшу, иначе If-None-Match: *
+        # получил бы 304 для несуществующего сервера
+        if membership_cache.get_owner_id(db, server_id) is None:
+            raise HTTPException(status_code=404, detail="Server not found")
+        return cached
     db_server = crud.get_server(db=db, server_id=server_id)
     if db_server is None:
         raise HTTPException(status_code=404, detail="Server not found")
+    response.headers.update(etag_headers(etag))
     return db_server
 
-@app.put("/servers/{server_id}", response_model=schemas.Server)
+@app.get("/servers/{server_id}/bootstrap", response_model=schemas.ServerBootstrap)
+@query_budget(10)  # 6 + 4 на сброс отложенных отметок о прочтении
+def read_server_bootstrap(
+    server_id: int,
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Свои отметки о прочтении должны быть видны сразу
+    if read_state_writer.has_pending(current_user.id):
+        read_state_writer.flush()
+    bootstrap = crud.get_server_bootstrap(db=db, server_id=server_id, user_id=current_user.id)
+    if bootstrap is None:
+        raise HTTPException(status_code=404, detail="Server not found")
+    if bootstrap["membership"] is None:
+        raise HTTPException(status_code=403, detail="Not a member of this server")
+    return bootstrap
+
+@app.put(
+    "/servers/{server_id}",
+    response_model=schemas.Server,
+    dependencies=[Depends(auth.require(Permission.MANAGE_SERVER))]
+)
 def update_server(
     server_id: int,
     server: schemas.ServerUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
     updated_server = crud.update_server(db=db, server_id=server_id, server=server)
     crud.create_audit_log(
         db=db,
@@ -599,13 +763,13 @@ def update_server(
 @app.delete("/servers/{server_id}")
 def delete_server(
     server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
+    owner_id = membership_cache.get_owner_id(db, server_id)
+    if owner_id is None:
         raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
+    if owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
     crud.create_audit_log(
@@ -620,18 +784,15 @@ def delete_server(
     return crud.delete_server(db=db, server_id=server_id)
 
 @app.post("/servers/{server_id}/roles/", response_model=schemas.Role)
+@query_budget(6)
 def create_role(
     server_id: int,
     role: schemas.RoleCreate,
-    current_user: models.User = Depends(auth.get_current_user),
+    membership: Membership = Depends(auth.require(Permission.MANAGE_ROLES)),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
+    auth.check_grant(membership, role.permissions)
     created_role = crud.create_role(db=db, role=role, server_id=server_id)
     crud.create_audit_log(
         db=db,
@@ -645,35 +806,36 @@ def create_role(
     return created_role
 
 @app.get("/servers/{server_id}/roles/", response_model=List[schemas.Role])
+@query_budget(5)
 def read_roles(
     server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    request: Request,
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
+    if membership_cache.get_owner_id(db, server_id) is None:
         raise HTTPException(status_code=404, detail="Server not found")
-    return crud.get_server_roles(db=db, server_id=server_id)
+    etag = resource_versions.etag(db, "roles", server_id)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    return list_response(schemas.Role, crud.get_server_roles(db=db, server_id=server_id), etag_headers(etag))
 
 @app.put("/roles/{role_id}", response_model=schemas.Role)
+@query_budget(7)
 def update_role(
     role_id: int,
     role: schemas.RoleUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
+    membership: Membership = Depends(auth.require(Permission.MANAGE_ROLES)),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_role = crud.get_role(db=db, role_id=role_id)
-    if db_role is None:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_role.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
+    if role.permissions is not None:
+        auth.check_grant(membership, role.permissions)
     updated_role = crud.update_role(db=db, role_id=role_id, role=role)
     crud.create_audit_log(
         db=db,
-        server_id=db_role.server_id,
+        server_id=membership.server_id,
         user_id=current_user.id,
         action="update_role",
         target_type="role",
@@ -685,20 +847,13 @@ def update_role(
 @app.delete("/roles/{role_id}")
 def delete_role(
     role_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    membership: Membership = Depends(auth.require(Permission.MANAGE_ROLES)),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_role = crud.get_role(db=db, role_id=role_id)
-    if db_role is None:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_role.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
     crud.create_audit_log(
         db=db,
-        server_id=db_role.server_id,
+        server_id=membership.server_id,
         user_id=current_user.id,
         action="delete_role",
         target_type="role",
@@ -707,19 +862,17 @@ def delete_role(
     )
     return crud.delete_role(db=db, role_id=role_id)
 
-@app.post("/servers/{server_id}/channels/", response_model=schemas.Channel)
+@app.post(
+    "/servers/{server_id}/channels/",
+    response_model=schemas.Channel,
+    dependencies=[Depends(auth.require(Permission.MANAGE_CHANNELS))]
+)
 def create_channel(
     server_id: int,
     channel: schemas.ChannelCreate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
     created_channel = crud.create_channel(db=db, channel=channel, server_id=server_id)
     crud.create_audit_log(
         db=db,
@@ -732,36 +885,42 @@ def create_channel(
     )
     return created_channel
 
-@app.get("/servers/{server_id}/channels/", response_model=List[schemas.Channel])
+@app.get("/servers/{server_id}/channels/", response_model=List[schemas.ChannelWithReadState])
+@query_budget(8)  # 4 + 4 на сброс отложенных отметок о прочтении
 def read_channels(
     server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
+    if membership_cache.get_owner_id(db, server_id) is None:
         raise HTTPException(status_code=404, detail="Server not found")
-    return crud.get_server_channels(db=db, server_id=server_id)
+    # Свои отметки о прочтении должны быть видны сразу
+    if read_state_writer.has_pending(current_user.id):
+        read_state_writer.flush()
+    return crud.get_server_channels_with_read_state(db=db, server_id=server_id, user_id=current_user.id)
+
+@app.post("/channels/{channel_id}/ack", dependencies=[Depends(auth.require(Permission.VIEW_CHANNEL))])
+@query_budget(4)
+def ack_channel(
+    channel_id: int,
+    ack: schemas.ReadStateAck,
+    current_user: UserSnapshot = Depends(auth.get_current_user)
+):
+    read_state_writer.ack(current_user.id, channel_id, ack.message_id)
+    return {"message": "Acknowledged"}
 
 @app.put("/channels/{channel_id}", response_model=schemas.Channel)
 def update_channel(
     channel_id: int,
     channel: schemas.ChannelUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
+    membership: Membership = Depends(auth.require(Permission.MANAGE_CHANNELS)),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_channel.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
     updated_channel = crud.update_channel(db=db, channel_id=channel_id, channel=channel)
     crud.create_audit_log(
         db=db,
-        server_id=db_channel.server_id,
+        server_id=membership.server_id,
         user_id=current_user.id,
         action="update_channel",
         target_type="channel",
@@ -773,20 +932,13 @@ def update_channel(
 @app.delete("/channels/{channel_id}")
 def delete_channel(
     channel_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    membership: Membership = Depends(auth.require(Permission.MANAGE_CHANNELS)),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_channel.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
     crud.create_audit_log(
         db=db,
-        server_id=db_channel.server_id,
+        server_id=membership.server_id,
         user_id=current_user.id,
         action="delete_channel",
         target_type="channel",
@@ -795,16 +947,22 @@ def delete_channel(
     )
     return crud.delete_channel(db=db, channel_id=channel_id)
 
-@app.post("/channels/{channel_id}/messages/", response_model=schemas.Message)
+@app.post(
+    "/channels/{channel_id}/messages/",
+    response_model=schemas.Message,
+    dependencies=[Depends(auth.require(Permission.SEND_MESSAGES))]
+)
+@query_budget(7)
 def create_message(
     channel_id: int,
     message: schemas.MessageCreate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
+    if message.parent_id is not None:
+        db_parent = crud.get_message(db=db, message_id=message.parent_id)
+        if db_parent is None or db_parent.channel_id != channel_id:
+            raise HTTPException(status_code=400, detail="Parent message not found in this channel")
     return crud.create_message(
         db=db,
         message=message,
@@ -812,24 +970,117 @@ def create_message(
         channel_id=channel_id
     )
 
-@app.get("/channels/{channel_id}/messages/", response_model=List[schemas.Message])
+@app.get(
+    "/channels/{channel_id}/messages/",
+    response_model=List[schemas.Message],
+    dependencies=[Depends(auth.require(Permission.VIEW_CHANNEL))]
+)
+@query_budget(8)
 def read_messages(
     channel_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    request: Request,
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db),
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    before: Optional[int] = None
 ):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    return crud.get_channel_messages(db=db, channel_id=channel_id, skip=skip, limit=limit)
+    # Первая страница горячих каналов отдается из кэша без запросов к БД
+    use_cache = skip == 0 and before is None and limit <= config.MESSAGE_CACHE_PAGE_SIZE
+    if use_cache:
+        page = message_cache.get_page(channel_id, limit, current_user.id)
+        if page is not None:
+            encoding = choose_encoding(request.headers.get("accept-encoding"))
+            if encoding is None or len(page) < config.COMPRESSION_MIN_SIZE:
+                return Response(content=page, media_type="application/json")
+            # Сжатая страница переиспользуется, пока канал не изменился
+            return Response(
+                content=message_cache.compress_page(channel_id, page, encoding),
+                media_type="application/json",
+                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+            )
+
+    if not use_cache:
+        messages = crud.get_channel_messages(
+            db=db, channel_id=channel_id, skip=skip, limit=limit, before=before, user_id=current_user.id
+        )
+        return list_response(schemas.Message, crud.attach_reaction_counts(db, messages, current_user.id))
+
+    generation = message_cache.generation(channel_id)
+    messages = crud.get_channel_messages(
+        db=db, channel_id=channel_id, limit=config.MESSAGE_CACHE_PAGE_SIZE, user_id=current_user.id
+    )
+    live = [message for message in messages if not getattr(message, "is_archived", False)]
+    reactors = crud.get_message_reactors(db, [message.id for message in live])
+    # Архивные сообщения в кэш не попадают, поэтому такая страница не считается полной
+    complete = len(messages) < config.MESSAGE_CACHE_PAGE_SIZE and len(live) == len(messages)
+    serialized = message_cache.fill(channel_id, live, reactors, generation, complete)
+    items = [item.render(current_user.id) for item in serialized]
+    items += [message.model_dump_json().encode() for message in messages[len(live):]]
+    return Response(content=b"[" + b",".join(items[:limit]) + b"]", media_type="application/json")
+
+@app.get("/channels/{channel_id}/export", dependencies=[Depends(auth.require(Permission.VIEW_CHANNEL))])
+def export_channel(
+    channel_id: int,
+    gzip: bool = False,
+    current_user: UserSnapshot = Depends(auth.get_current_user)
+):
+    return export.export_response(
+        export.iter_channel_export(channel_id, current_user.id),
+        filename=f"channel-{channel_id}.ndjson",
+        gzip=gzip
+    )
+
+@app.get("/metrics/message-cache")
+def read_message_cache_stats(current_user: UserSnapshot = Depends(auth.get_current_user)):
+    return message_cache.stats()
+
+@app.get("/metrics/membership-cache")
+def read_membership_cache_stats(current_user: UserSnapshot = Depends(auth.get_current_user)):
+    return membership_cache.stats()
+
+@app.get("/metrics/user-cache")
+def read_user_cache_stats(current_user: UserSnapshot = Depends(auth.get_current_user)):
+    return user_cache.stats()
+
+@app.get("/metrics/token-cache")
+def read_token_cache_stats(current_user: UserSnapshot = Depends(auth.get_current_user)):
+    return token_cache.stats()
+
+@app.get("/messages/{message_id}/thread", response_model=schemas.MessageThread)
+@query_budget(7)
+def read_thread(
+    message_id: int,
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: Session = Depends(get_db),
+    max_depth: int = Query(10, ge=1, le=50),
+    after: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=500)
+):
+    root = crud.get_message(db, message_id)
+    if root is None or not auth.has_permission(db, current_user.id, Permission.VIEW_CHANNEL, channel_id=root.channel_id):
+        raise HTTPException(status_code=404, detail="Message not found")
+    rows = crud.get_message_thread(db=db, message_id=message_id, max_depth=max_depth, after=after, limit=limit)
+    if not rows and after is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    messages = []
+    for db_message, depth in rows:
+        db_message.depth = depth
+        messages.append(db_message)
+    crud.attach_reaction_counts(db, messages, current_user.id)
+    return {
+        "root_id": message_id,
+        "messages": messages,
+        "next_cursor": messages[-1].id if len(messages) == limit else None
+    }
 
 @app.put("/messages/{message_id}", response_model=schemas.Message)
+@query_budget(4)
 def update_message(
     message_id: int,
     message: schemas.MessageUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     db_message = crud.get_message(db=db, message_id=message_id)
@@ -837,114 +1088,215 @@ def update_message(
         raise HTTPException(status_code=404, detail="Message not found")
     if db_message.author_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.update_message(db=db, message_id=message_id, message=message)
+    updated_message = crud.update_message(db=db, message_id=message_id, message=message)
+    return crud.attach_reaction_counts(db, [updated_message], current_user.id)[0]
 
 @app.delete("/messages/{message_id}")
 def delete_message(
     message_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     db_message = crud.get_message(db=db, message_id=message_id)
     if db_message is None:
         raise HTTPException(status_code=404, detail="Message not found")
-    if db_message.author_id != current_user.id:
+    # Чужие сообщения могут удалять модераторы канала
+    if db_message.author_id != current_user.id and not auth.has_permission(
+        db, current_user.id, Permission.MANAGE_MESSAGES, channel_id=db_message.channel_id
+    ):
         raise HTTPException(status_code=403, detail="Not enough permissions")
     return crud.delete_message(db=db, message_id=message_id)
 
 @app.post("/messages/{message_id}/reactions/{emoji}")
+@query_budget(3)
 def add_reaction(
     message_id: int,
     emoji: str,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     db_message = crud.get_message(db=db, message_id=message_id)
     if db_message is None:
         raise HTTPException(status_code=404, detail="Message not found")
-    return crud.add_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    return crud.add_message_reaction(
+        db=db,
+        message_id=message_id,
+        user_id=current_user.id,
+        emoji=emoji,
+        channel_id=db_message.channel_id
+    )
 
 @app.delete("/messages/{message_id}/reactions/{emoji}")
+@query_budget(3)
 def remove_reaction(
     message_id: int,
     emoji: str,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     db_message = crud.get_message(db=db, message_id=message_id)
     if db_message is None:
         raise HTTPException(status_code=404, detail="Message not found")
-    return crud.remove_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    return crud.remove_message_reaction(
+        db=db,
+        message_id=message_id,
+        user_id=current_user.id,
+        emoji=emoji,
+        channel_id=db_message.channel_id
+    )
 
-@app.get("/servers/{server_id}/audit-logs/", response_model=List[schemas.AuditLog])
+@app.get(
+    "/servers/{server_id}/audit-logs/",
+    response_model=List[schemas.AuditLog],
+    dependencies=[Depends(auth.require(Permission.VIEW_AUDIT_LOG))]
+)
 def read_audit_logs(
     server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 100
 ):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.get_server_audit_logs(db=db, server_id=server_id, skip=skip, limit=limit)
+    # Записи аудита пишутся в фоне, дописываем их перед чтением
+    event_sink.flush()
+    return list_response(
+        schemas.AuditLog, crud.get_server_audit_logs(db=db, server_id=server_id, skip=skip, limit=limit)
+    )
 
-# Media endpoints
-@app.post("/channels/{channel_id}/media/", response_model=schemas.Media)
-def upload_media(
-    channel_id: int,
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+@app.get("/servers/{server_id}/audit-logs/export", dependencies=[Depends(auth.require(Permission.VIEW_AUDIT_LOG))])
+def export_audit_logs(
+    server_id: int,
+    gzip: bool = False
 ):
-    # Проверяем права доступа к каналу
-    channel = crud.get_channel(db, channel_id)
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    # Определяем тип медиа
-    content_type = file.content_type
+    event_sink.flush()
+    return export.export_response(
+        export.iter_audit_log_export(server_id),
+        filename=f"server-{server_id}-audit-logs.ndjson",
+        gzip=gzip
+    )
+
+# Media endpoints
+_SHA256_PATTERN = "^[0-9a-f]{64}$"
+# Эти типы браузер может показывать сам, остальное отдается как вложение
+_INLINE_MEDIA_TYPES = ("image/png", "image/jpeg", "image/gif", "video/", "audio/", "text/plain", "application/pdf")
+
+def _media_type(content_type: str) -> models.MediaType:
     if content_type.startswith('image/'):
-        media_type = models.MediaType.IMAGE
+        return models.MediaType.IMAGE
     elif content_type.startswith('video/'):
-        media_type = models.MediaType.VIDEO
+        return models.MediaType.VIDEO
     elif content_type.startswith('audio/'):
-        media_type = models.MediaType.AUDIO
-    else:
-        media_type = models.MediaType.FILE
-    
-    # Загружаем файл
-    file_location = f"uploads/{file.filename}"
-    with open(file_location, "wb+") as file_object:
-        file_object.write(file.file.read())
-    
-    # Создаем запись в базе данных
-    media = schemas.MediaCreate(
-        url=f"/uploads/{file.filename}",
-        type=media_type,
-        name=file.filename,
-        size=file.size
+        return models.MediaType.AUDIO
+    return models.MediaType.FILE
+
+@app.post("/channels/{channel_id}/media/", response_model=schemas.Media,
+          dependencies=[Depends(auth.require(Permission.SEND_MESSAGES))])
+async def upload_media(
+    channel_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserSnapshot = Depends(auth.get_current_user)
+):
+    # Если клиент заранее прислал хэш и такой файл уже есть, содержимое
+    # только хэшируется для проверки, на диск ничего не пишется
+    declared_sha256 = (request.headers.get("x-content-sha256") or "").lower()
+    known = re.match(_SHA256_PATTERN, declared_sha256) is not None and \
+        await async_crud.get_blob(db, declared_sha256) is not None
+    # Не держим транзакцию, пока идет загрузка
+    await db.rollback()
+
+    # Файл пишется на диск по частям, лимит размера проверяется по мере получения
+    upload = await receive_upload(request, write=not known)
+    try:
+        if declared_sha256 and upload.sha256 != declared_sha256:
+            raise HTTPException(status_code=400, detail="Content does not match X-Content-SHA256")
+        if await async_crud.acquire_blob(db, upload.sha256, upload.size, upload.content_type):
+            if upload.path is None:
+                # Блоб успел удалить сборщик
+                raise HTTPException(status_code=409, detail="File is no longer stored, upload it again")
+            # Новое содержимое: файл кладется, пока строка blobs заблокирована
+            await run_in_threadpool(blob_store.place, upload.path, upload.sha256)
+            upload.path = None
+
+        media = schemas.MediaCreate(
+            url=blob_store.url(upload.sha256),
+            type=_media_type(upload.content_type),
+            name=upload.filename,
+            size=upload.size
+        )
+        return await async_crud.create_media(db, media, current_user.id, channel_id, upload.sha256)
+    finally:
+        # Дубликат уже сохраненного файла не нужен
+        await run_in_threadpool(upload.discard)
+
+@app.post("/channels/{channel_id}/media/by-hash", response_model=schemas.Media,
+          dependencies=[Depends(auth.require(Permission.SEND_MESSAGES))])
+async def attach_media_by_hash(
+    channel_id: int,
+    media: schemas.MediaByHash,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserSnapshot = Depends(auth.get_current_user)
+):
+    """
+    Attach a file the caller has already uploaded without sending it again.
+    404 means it has to be uploaded.
+    """
+    # Один хэш не дает доступа к файлу: только свои загрузки
+    if not await async_crud.has_uploaded_blob(db, current_user.id, media.sha256) or \
+            not await async_crud.reference_blob(db, media.sha256):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    blob = await async_crud.get_blob(db, media.sha256)
+    db_media = schemas.MediaCreate(
+        url=blob_store.url(blob.sha256),
+        type=_media_type(blob.content_type or ""),
+        name=os.path.basename(media.name.replace("\\", "/")),
+        size=blob.size
     )
-    
-    return crud.create_media(db, media, current_user.id, channel_id)
+    return await async_crud.create_media(db, db_media, current_user.id, channel_id, blob.sha256)
 
-@app.get("/channels/{channel_id}/media/", response_model=List[schemas.Media])
+@app.get("/media/blobs/{sha256}")
+def get_blob(
+    request: Request,
+    sha256: str = Path(..., pattern=_SHA256_PATTERN),
+    db: Session = Depends(get_db),
+    current_user: UserSnapshot = Depends(auth.get_current_user)
+):
+    blob = crud.get_blob(db, sha256)
+    if blob is None or blob.ref_count <= 0:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    # Файл виден тому, кто видит хотя бы один канал, где он прикреплен
+    if not any(auth.has_permission(db, current_user.id, Permission.VIEW_CHANNEL, channel_id=channel_id)
+               for channel_id in crud.get_blob_channel_ids(db, sha256)):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    # Содержимое по хэшу не меняется
+    etag = f'"{sha256}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable",
+               "X-Content-Type-Options": "nosniff"}
+    not_modified_response = not_modified(request, etag)
+    if not_modified_response is not None:
+        not_modified_response.headers.update(headers)
+        return not_modified_response
+    content_type = blob.content_type or "application/octet-stream"
+    if not content_type.startswith(_INLINE_MEDIA_TYPES):
+        content_type = "application/octet-stream"
+        headers["Content-Disposition"] = "attachment"
+    return FileResponse(blob_store.path(sha256), media_type=content_type, headers=headers)
+
+@app.get("/channels/{channel_id}/media/", response_model=List[schemas.Media],
+         dependencies=[Depends(auth.require(Permission.VIEW_CHANNEL))])
 def get_channel_media(
     channel_id: int,
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
-    return crud.get_channel_media(db, channel_id, skip, limit)
+    return list_response(schemas.Media, crud.get_channel_media(db, channel_id, skip, limit))
 
 @app.delete("/media/{media_id}")
 def delete_media(
     media_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.delete_media(db, media_id)
 
@@ -954,7 +1306,7 @@ def create_game(
     channel_id: int,
     game: schemas.GameSessionCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.create_game_session(db, game, current_user.id, channel_id)
 
@@ -964,7 +1316,7 @@ def get_channel_games(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.get_channel_games(db, channel_id, skip, limit)
 
@@ -972,7 +1324,7 @@ def get_channel_games(
 def join_game(
     game_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.add_game_player(db, game_id, current_user.id)
 
@@ -982,7 +1334,7 @@ def update_player_status(
     user_id: int,
     player_data: Dict[str, Any],
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.update_game_player(db, game_id, user_id, player_data)
 
@@ -990,17 +1342,22 @@ def update_player_status(
 @app.get("/channels/{channel_id}/music/", response_model=List[schemas.MusicQueue])
 def get_music_queue(
     channel_id: int,
+    request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
-    return crud.get_music_queue(db, channel_id)
+    etag = resource_versions.etag(db, "music", channel_id)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    return list_response(schemas.MusicQueue, crud.get_music_queue(db, channel_id), etag_headers(etag))
 
 @app.post("/channels/{channel_id}/music/", response_model=schemas.MusicQueue)
 def add_to_queue(
     channel_id: int,
     music: schemas.MusicQueueCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.add_to_music_queue(db, music, current_user.id, channel_id)
 
@@ -1009,7 +1366,7 @@ def update_music_status(
     music_id: int,
     status: str,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.update_music_status(db, music_id, status)
 
@@ -1017,20 +1374,20 @@ def update_music_status(
 def remove_from_queue(
     music_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: UserSnapshot = Depends(auth.get_current_user)
 ):
     return crud.remove_from_music_queue(db, music_id)
 
-@app.post("/servers/{server_id}/invite", response_model=schemas.InviteCode)
+@app.post(
+    "/servers/{server_id}/invite",
+    response_model=schemas.InviteCode,
+    dependencies=[Depends(auth.require(Permission.CREATE_INVITE))]
+)
 def create_server_invite(
     server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    # Check if user is a member of the server
-    if not crud.is_user_server_member(db=db, user_id=current_user.id, server_id=server_id):
-        raise HTTPException(status_code=403, detail="Not a member of this server")
-    
     # Create invite code
     invite = crud.create_invite_code(db=db, server_id=server_id, user_id=current_user.id)
     
@@ -1050,30 +1407,30 @@ def create_server_invite(
 @app.post("/servers/join/{invite_code}")
 async def join_server(
     invite_code: str,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+    current_user: UserSnapshot = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Get server by invite code
-    server = crud.get_server_by_invite_code(db, invite_code)
+    server = await async_crud.get_server_by_invite_code(db, invite_code)
     if not server:
         raise HTTPException(status_code=404, detail="Invalid or expired invite code")
     
     # Check if user is already a member
-    if crud.is_user_server_member(db, current_user.id, server.id):
+    if await async_crud.is_user_server_member(db, current_user.id, server.id):
         raise HTTPException(status_code=400, detail="Already a member of this server")
     
     # Add user to server
-    member = crud.add_user_to_server(db, current_user.id, server.id)
+    member = await async_crud.add_user_to_server(db, current_user.id, server.id)
     
     # Log the action
-    crud.create_audit_log(
-        db=db,
+    event_sink.add_audit_log(
         server_id=server.id,
         user_id=current_user.id,
         action="join_server",
         target_type="server",
         target_id=server.id,
-        changes={}
+        changes={},
+        block=False
     )
     
     return {"message": "Successfully joined server", "server": server}
@@ -1082,7 +1439,7 @@ async def join_server(
 def update_credentials(
     user_id: int,
     credentials: schemas.UserCredentialsUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: UserSnapshot = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     # Only allow users to update their own credentials
@@ -1123,6 +1480,7 @@ def fix_swapped_credentials(
     
     db.commit()
     db.refresh(db_user)
+    user_cache.invalidate(user_id, db_user.email)
     
     return {"message": "Credentials fixed successfully"}
 
@@ -1143,4 +1501,4 @@ if __name__ == "__main__":
         exit(1)
         
     print(f"Starting server on port {port}")
-    uvicorn.run(app, host=config.SERVER_IP, port=port) 
\ No newline at end of file
+    uvicorn.run(app, host=config.SERVER_IP, port=port, ws_per_message_deflate=config.WS_PER_MESSAGE_DEFLATE) 
\ No newline at end of file
@@ -0,0 +1,310 @@
+import threading
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy import and_, insert, select, update
+
+import config
+import models
+from permissions import apply_overrides, compile_overrides, compile_permissions
+
+# Кэш членства в серверах.
+# Для пары (user_id, server_id) хранится участник, его роль и скомпилированная
+# маска прав, для сервера - владелец, для канала - сервер и переопределения
+# прав, так что проверки доступа на горячих маршрутах сводятся
+# к поиску в словаре. Изменения членства и ролей сбрасывают записи своего
+# сервера после коммита и увеличивают общий счетчик версий в таблице
+# cache_versions: другие процессы раз в MEMBERSHIP_CACHE_VERSION_CHECK_MS
+# сверяют его и очищают кэш целиком, если он изменился.
+
+_VERSION_KEY = "membership"
+_MISSING = object()
+
+class Membership:
+    __slots__ = ("user_id", "server_id", "member_id", "role_id", "role_type", "permissions", "is_owner", "mask")
+
+    def __init__(self, user_id: int, server_id: int, member_id: int, role_id: Optional[int],
+                 role_type: models.RoleType, permissions: Dict[str, Any], is_owner: bool):
+        self.user_id = user_id
+        self.server_id = server_id
+        self.member_id = member_id
+        self.role_id = role_id
+        self.role_type = role_type
+        self.permissions = permissions
+        self.is_owner = is_owner
+        self.mask = compile_permissions(role_type, permissions, is_owner)
+
+    def channel_mask(self, channel: "ChannelAccess") -> int:
+        return apply_overrides(self.mask, self.role_id, channel.overrides)
+
+class ChannelAccess:
+    __slots__ = ("channel_id", "server_id", "overrides")
+
+    def __init__(self, channel_id: int, server_id: int, overrides: Dict[str, Tuple[int, int]]):
+        self.channel_id = channel_id
+        self.server_id = server_id
+        self.overrides = overrides
+
+def _membership_statement(user_id: int, server_id: int):
+    return select(
+        models.Server.owner_id,
+        models.ServerMember.id,
+        models.ServerMember.role_id,
+        models.ServerMember.role_type,
+        models.Role.permissions
+    )\
+        .select_from(models.Server)\
+        .outerjoin(models.ServerMember, and_(
+            models.ServerMember.server_id == models.Server.id,
+            models.ServerMember.user_id == user_id
+        ))\
+        .outerjoin(models.Role, models.Role.id == models.ServerMember.role_id)\
+        .where(models.Server.id == server_id)
+
+def _channel_statement(channel_id: int):
+    return select(models.Channel.server_id, models.Channel.settings).where(models.Channel.id == channel_id)
+
+def _version_statement(name: str = _VERSION_KEY):
+    return select(models.CacheVersion.version).where(models.CacheVersion.name == name)
+
+def _bump_statement(name: str = _VERSION_KEY):
+    # Новая версия возвращается тем же запросом (RETURNING)
+    return update(models.CacheVersion)\
+        .where(models.CacheVersion.name == name)\
+        .values(version=models.CacheVersion.version + 1)\
+        .returning(models.CacheVersion.version)
+
+def read_version(db, name: str = _VERSION_KEY) -> int:
+    return db.execute(_version_statement(name)).scalar() or 0
+
+def bump_version(db, name: str = _VERSION_KEY) -> int:
+    """
+    Increment the shared version inside the caller's transaction.
+    Returns the new version.
+    """
+    version = db.execute(_bump_statement(name)).scalar()
+    if version is None:
+        db.execute(insert(models.CacheVersion).values(name=name, version=1))
+        return 1
+    return version
+
+async def bump_version_async(db, name: str = _VERSION_KEY) -> int:
+    version = (await db.execute(_bump_statement(name))).scalar()
+    if version is None:
+        await db.execute(insert(models.CacheVersion).values(name=name, version=1))
+        return 1
+    return version
+
+class MembershipCache:
+    def __init__(self, check_interval_ms: int, max_entries: int):
+        self.check_interval = check_interval_ms / 1000
+        self.max_entries = max_entries
+        self.members: Dict[Tuple[int, int], Optional[Membership]] = {}
+        self.by_server: Dict[int, Set[int]] = {}
+        # server_id -> owner_id, None если сервера нет
+        self.owners: Dict[int, Optional[int]] = {}
+        # channel_id -> ChannelAccess, None если канала нет
+        self.channels: Dict[int, Optional[ChannelAccess]] = {}
+        self.channel_generations: Dict[int, int] = {}
+        # Счетчики сбросов: загрузка, начатая до сброса, не попадает в кэш
+        self.generations: Dict[int, int] = {}
+        self.epoch = 0
+        self.version: Optional[int] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db, user_id: int, server_id: int) -> Optional[Membership]:
+        """
+        Membership of a user in a server, or None if they are not a member
+        (or the server does not exist).
+        """
+        if self._version_check_due():
+            self._apply_version(db.execute(_version_statement()).scalar())
+        entry, generation = self._lookup(user_id, server_id)
+        if entry is not _MISSING:
+            return entry
+        row = db.execute(_membership_statement(user_id, server_id)).first()
+        return self._store(user_id, server_id, row, generation)
+
+    async def get_async(self, db, user_id: int, server_id: int) -> Optional[Membership]:
+        if self._version_check_due():
+            self._apply_version((await db.execute(_version_statement())).scalar())
+        entry, generation = self._lookup(user_id, server_id)
+        if entry is not _MISSING:
+            return entry
+        row = (await db.execute(_membership_statement(user_id, server_id))).first()
+        return self._store(user_id, server_id, row, generation)
+
+    def get_owner_id(self, db, server_id: int) -> Optional[int]:
+        """
+        Owner of a server, or None if the server does not exist.
+        """
+        if self._version_check_due():
+            self._apply_version(db.execute(_version_statement()).scalar())
+        with self.lock:
+            if server_id in self.owners:
+                self.hits += 1
+                return self.owners[server_id]
+            self.misses += 1
+            generation = self._generation(server_id)
+        owner_id = db.execute(
+            select(models.Server.owner_id).where(models.Server.id == server_id)
+        ).scalar()
+        with self.lock:
+            if self._generation(server_id) == generation:
+                self._make_room()
+                self.owners[server_id] = owner_id
+        return owner_id
+
+    def get_channel(self, db, channel_id: int) -> Optional[ChannelAccess]:
+        """
+        Server and compiled permission overrides of a channel, or None if
+        the channel does not exist.
+        """
+        if self._version_check_due():
+            self._apply_version(db.execute(_version_statement()).scalar())
+        access, generation = self._lookup_channel(channel_id)
+        if access is not _MISSING:
+            return access
+        row = db.execute(_channel_statement(channel_id)).first()
+        return self._store_channel(channel_id, row, generation)
+
+    async def get_channel_async(self, db, channel_id: int) -> Optional[ChannelAccess]:
+        if self._version_check_due():
+            self._apply_version((await db.execute(_version_statement())).scalar())
+        access, generation = self._lookup_channel(channel_id)
+        if access is not _MISSING:
+            return access
+        row = (await db.execute(_channel_statement(channel_id))).first()
+        return self._store_channel(channel_id, row, generation)
+
+    def invalidate_channel(self, channel_id: int, version: Optional[int] = None) -> None:
+        with self.lock:
+            self._make_room()
+            self.channel_generations[channel_id] = self.channel_generations.get(channel_id, 0) + 1
+            self.channels.pop(channel_id, None)
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def invalidate(self, server_id: int, user_id: Optional[int] = None, version: Optional[int] = None) -> None:
+        """
+        Drop cached entries of a server (or of one member). `version` is the
+        shared version written by the same transaction: if it directly
+        follows ours, no other process has changed anything in between and
+        the rest of the cache stays valid.
+        """
+        with self.lock:
+            self._make_room()
+            self.generations[server_id] = self.generations.get(server_id, 0) + 1
+            if user_id is None:
+                self.owners.pop(server_id, None)
+                for member_user_id in self.by_server.pop(server_id, set()):
+                    self.members.pop((member_user_id, server_id), None)
+            else:
+                self.members.pop((user_id, server_id), None)
+                self.by_server.get(server_id, set()).discard(user_id)
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def clear(self) -> None:
+        with self.lock:
+            self._clear_locked()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.members),
+                "version": self.version
+            }
+
+    def _version_check_due(self) -> bool:
+        return time.monotonic() - self.checked_at >= self.check_interval
+
+    def _apply_version(self, version: Optional[int]) -> None:
+        version = version or 0
+        self.checked_at = time.monotonic()
+        if self.version is not None and version != self.version:
+            self.clear()
+        self.version = version
+
+    def _clear_locked(self) -> None:
+        # Новая эпоха отменяет загрузки, начатые до сброса, поэтому счетчики
+        # сбросов тоже можно обнулить
+        self.epoch += 1
+        self.members.clear()
+        self.by_server.clear()
+        self.owners.clear()
+        self.channels.clear()
+        self.generations.clear()
+        self.channel_generations.clear()
+
+    def _make_room(self) -> None:
+        # Под self.lock. Все словари ограничены max_entries, в том числе
+        # отрицательные ответы по несуществующим серверам и счетчики сбросов
+        if max(len(self.members), len(self.owners), len(self.channels),
+               len(self.generations), len(self.channel_generations)) >= self.max_entries:
+            self._clear_locked()
+
+    def _generation(self, server_id: int) -> Tuple[int, int]:
+        return self.epoch, self.generations.get(server_id, 0)
+
+    def _lookup(self, user_id: int, server_id: int):
+        with self.lock:
+            entry = self.members.get((user_id, server_id), _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry, self._generation(server_id)
+
+    def _lookup_channel(self, channel_id: int):
+        with self.lock:
+            access = self.channels.get(channel_id, _MISSING)
+            if access is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return access, (self.epoch, self.channel_generations.get(channel_id, 0))
+
+    def _store_channel(self, channel_id: int, row, generation: Tuple[int, int]) -> Optional[ChannelAccess]:
+        access = None
+        if row is not None:
+            server_id, settings = row
+            access = ChannelAccess(channel_id, server_id, compile_overrides(settings))
+        with self.lock:
+            if (self.epoch, self.channel_generations.get(channel_id, 0)) != generation:
+                return access
+            self._make_room()
+            self.channels[channel_id] = access
+        return access
+
+    def _store(self, user_id: int, server_id: int, row, generation: Tuple[int, int]) -> Optional[Membership]:
+        entry = None
+        owner_id = None
+        if row is not None:
+            owner_id, member_id, role_id, role_type, permissions = row
+            if member_id is not None:
+                entry = Membership(
+                    user_id, server_id, member_id, role_id, role_type,
+                    permissions or {}, owner_id == user_id
+                )
+        with self.lock:
+            if self._generation(server_id) != generation:
+                return entry
+            self._make_room()
+            self.members[(user_id, server_id)] = entry
+            self.by_server.setdefault(server_id, set()).add(user_id)
+            self.owners[server_id] = owner_id
+        return entry
+
+# Create a global instance
+membership_cache = MembershipCache(
+    config.MEMBERSHIP_CACHE_VERSION_CHECK_MS,
+    config.MEMBERSHIP_CACHE_MAX_ENTRIES
+)
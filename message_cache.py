@@ -0,0 +1,272 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import config
+import schemas
+from compression import compress
+
+# Кэш последних сообщений активных каналов.
+# Для каждого канала хранится до MESSAGE_CACHE_PAGE_SIZE последних сообщений,
+# уже сериализованных в JSON, поэтому первая страница отдается без запроса к БД.
+# Реакции хранятся отдельно (emoji -> множество пользователей), чтобы поле `me`
+# считалось для каждого читателя в памяти.
+# Сжатые варианты страниц хранятся по хэшу содержимого, пока канал не
+# изменится: страница без реакций одинакова для всех читателей.
+
+_EMPTY_REACTIONS = b',"reaction_counts":[]}'
+# Примерная стоимость одного пользователя в множестве реакций
+_REACTOR_SIZE = 32
+
+class CachedMessage:
+    __slots__ = ("body", "reactions")
+
+    def __init__(self, body: bytes, reactions: Optional[Dict[str, Set[int]]] = None):
+        # JSON сообщения без поля reaction_counts и закрывающей скобки
+        self.body = body
+        self.reactions: Dict[str, Set[int]] = reactions or {}
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(emoji) + _REACTOR_SIZE * len(users) for emoji, users in self.reactions.items())
+
+    def render(self, user_id: Optional[int] = None) -> bytes:
+        if not self.reactions:
+            return self.body + _EMPTY_REACTIONS
+        counts = [
+            {"emoji": emoji, "count": len(users), "me": user_id in users}
+            for emoji, users in sorted(self.reactions.items())
+        ]
+        return self.body + b',"reaction_counts":' + json.dumps(counts, separators=(",", ":"), ensure_ascii=False).encode() + b"}"
+
+class ChannelEntry:
+    __slots__ = ("messages", "complete", "size", "compressed")
+
+    def __init__(self):
+        # message_id -> CachedMessage, от новых к старым
+        self.messages: "OrderedDict[int, CachedMessage]" = OrderedDict()
+        # True, если в канале нет сообщений старше закэшированных
+        self.complete = False
+        self.size = 0
+        # (кодировка, хэш страницы) -> сжатая страница
+        self.compressed: Dict[Tuple[str, bytes], bytes] = {}
+
+class MessageCache:
+    def __init__(self, page_size: int, max_bytes: int):
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        self.channels: "OrderedDict[int, ChannelEntry]" = OrderedDict()
+        self.message_channels: Dict[int, int] = {}
+        self.generations: Dict[int, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def serialize(message, reactions: Optional[Dict[str, Set[int]]] = None) -> CachedMessage:
+        data = schemas.Message.model_validate(message).model_dump_json(exclude={"reaction_counts"}).encode()
+        return CachedMessage(data[:-1], reactions)
+
+    @staticmethod
+    def render(items: List[CachedMessage], user_id: Optional[int] = None) -> bytes:
+        return b"[" + b",".join(item.render(user_id) for item in items) + b"]"
+
+    def get_page(self, channel_id: int, limit: int, user_id: Optional[int] = None) -> Optional[bytes]:
+        """
+        Return the first page of a channel as JSON bytes, or None on a miss.
+        """
+        with self.lock:
+            entry = self.channels.get(channel_id)
+            if entry is None or (len(entry.messages) < limit and not entry.complete):
+                self.misses += 1
+                return None
+            self.channels.move_to_end(channel_id)
+            self.hits += 1
+            items = []
+            for item in entry.messages.values():
+                if len(items) >= limit:
+                    break
+                items.append(item.render(user_id))
+        return b"[" + b",".join(items) + b"]"
+
+    def compress_page(self, channel_id: int, page: bytes, encoding: str) -> bytes:
+        """
+        Compressed form of a page returned by get_page, reused while the
+        channel does not change.
+        """
+        key = (encoding, hashlib.blake2b(page, digest_size=16).digest())
+        with self.lock:
+            entry = self.channels.get(channel_id)
+            if entry is not None and key in entry.compressed:
+                return entry.compressed[key]
+        data = compress(page, encoding)
+        with self.lock:
+            # Если канал изменился, страница с этим хэшем больше не выдается
+            if self.channels.get(channel_id) is entry and entry is not None:
+                if len(entry.compressed) >= config.MESSAGE_CACHE_COMPRESSED_VARIANTS:
+                    self._drop_compressed(entry)
+                entry.compressed[key] = data
+                self._resize(entry, len(data))
+                self._evict()
+        return data
+
+    def generation(self, channel_id: int) -> int:
+        with self.lock:
+            return self.generations.get(channel_id, 0)
+
+    def fill(self, channel_id: int, messages: List, reactions: Dict[int, Dict[str, Set[int]]],
+             generation: int, complete: Optional[bool] = None) -> List[CachedMessage]:
+        """
+        Store the newest page of a channel loaded from the database and
+        return the serialized messages. The cache is left untouched if the
+        channel was written to after `generation` was read. By default the
+        channel counts as complete when fewer than page_size messages exist.
+        """
+        serialized = [(message.id, self.serialize(message, reactions.get(message.id))) for message in messages]
+        with self.lock:
+            if self.generations.get(channel_id, 0) != generation:
+                return [item for _, item in serialized]
+            self._drop(channel_id)
+            entry = ChannelEntry()
+            for message_id, item in serialized[:self.page_size]:
+                entry.messages[message_id] = item
+                entry.size += item.size
+                self.message_channels[message_id] = channel_id
+            entry.complete = len(serialized) < self.page_size if complete is None else complete
+            self.channels[channel_id] = entry
+            self.total_bytes += entry.size
+            self._evict()
+        return [item for _, item in serialized]
+
+    def add_message(self, message) -> None:
+        item = self.serialize(message)
+        with self.lock:
+            self._bump(message.channel_id)
+            entry = self.channels.get(message.channel_id)
+            if entry is None:
+                return
+            # Потоки одной пачки конвейера просыпаются в произвольном порядке,
+            # поэтому сообщение встает на свое место по id, а не просто в начало
+            newer = [message_id for message_id in entry.messages if message_id > message.id]
+            entry.messages[message.id] = item
+            entry.messages.move_to_end(message.id, last=False)
+            for message_id in reversed(newer):
+                entry.messages.move_to_end(message_id, last=False)
+            self._resize(entry, item.size)
+            self.message_channels[message.id] = message.channel_id
+            while len(entry.messages) > self.page_size:
+                old_id, old_item = entry.messages.popitem()
+                self._resize(entry, -old_item.size)
+                self.message_channels.pop(old_id, None)
+                entry.complete = False
+            self._evict()
+
+    def update_message(self, message) -> None:
+        item = self.serialize(message)
+        with self.lock:
+            self._bump(message.channel_id)
+            entry = self.channels.get(message.channel_id)
+            if entry is None or message.id not in entry.messages:
+                return
+            old_item = entry.messages[message.id]
+            item.reactions = old_item.reactions
+            entry.messages[message.id] = item
+            self._resize(entry, item.size - old_item.size)
+            self._evict()
+
+    def remove_message(self, message_id: int, channel_id: Optional[int] = None) -> None:
+        with self.lock:
+            if channel_id is None:
+                channel_id = self.message_channels.get(message_id)
+                if channel_id is None:
+                    return
+            self._bump(channel_id)
+            entry = self.channels.get(channel_id)
+            if entry is None or message_id not in entry.messages:
+                return
+            item = entry.messages.pop(message_id)
+            self._resize(entry, -item.size)
+            self.message_channels.pop(message_id, None)
+
+    def add_reaction(self, message_id: int, channel_id: int, user_id: int, emoji: str) -> None:
+        with self.lock:
+            entry, item = self._find(message_id, channel_id)
+            if item is None:
+                return
+            old_size = item.size
+            item.reactions.setdefault(emoji, set()).add(user_id)
+            self._resize(entry, item.size - old_size)
+            self._evict()
+
+    def remove_reaction(self, message_id: int, channel_id: int, user_id: int, emoji: str) -> None:
+        with self.lock:
+            entry, item = self._find(message_id, channel_id)
+            if item is None or emoji not in item.reactions:
+                return
+            old_size = item.size
+            item.reactions[emoji].discard(user_id)
+            if not item.reactions[emoji]:
+                del item.reactions[emoji]
+            self._resize(entry, item.size - old_size)
+
+    def is_cached(self, message_id: int) -> bool:
+        with self.lock:
+            return message_id in self.message_channels
+
+    def drop_channel(self, channel_id: int) -> None:
+        with self.lock:
+            self._bump(channel_id)
+            self._drop(channel_id)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "channels": len(self.channels),
+                "bytes": self.total_bytes
+            }
+
+    def _find(self, message_id: int, channel_id: int):
+        self._bump(channel_id)
+        entry = self.channels.get(channel_id)
+        if entry is None:
+            return None, None
+        return entry, entry.messages.get(message_id)
+
+    def _resize(self, entry: ChannelEntry, delta: int) -> None:
+        entry.size += delta
+        self.total_bytes += delta
+
+    def _drop_compressed(self, entry: ChannelEntry) -> None:
+        size = sum(len(data) for data in entry.compressed.values())
+        entry.compressed.clear()
+        self._resize(entry, -size)
+
+    def _bump(self, channel_id: int) -> None:
+        self.generations[channel_id] = self.generations.get(channel_id, 0) + 1
+        entry = self.channels.get(channel_id)
+        if entry is not None and entry.compressed:
+            self._drop_compressed(entry)
+
+    def _drop(self, channel_id: int) -> None:
+        entry = self.channels.pop(channel_id, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.size
+        for message_id in entry.messages:
+            self.message_channels.pop(message_id, None)
+
+    def _evict(self) -> None:
+        # Вытесняем наименее используемые каналы, пока не уложимся в лимит
+        while self.total_bytes > self.max_bytes and self.channels:
+            channel_id = next(iter(self.channels))
+            self._drop(channel_id)
+
+# Create a global instance
+message_cache = MessageCache(config.MESSAGE_CACHE_PAGE_SIZE, config.MESSAGE_CACHE_MAX_BYTES)
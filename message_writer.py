@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+
+import config
+import models
+from database import SessionLocal
+
+# Конвейер групповой записи сообщений.
+# Сообщения получают id сразу, складываются в очередь и записываются пачками
+# в одной транзакции. Запрос получает ответ только после коммита своей пачки,
+# поэтому гарантии сохранности те же, что и при записи по одному.
+# Рассчитан на один процесс: id выдаются из счетчика в памяти.
+
+_STOP = object()
+
+class MessageWriter:
+    def __init__(self, max_rows: int, interval_ms: int):
+        self.max_rows = max_rows
+        self.interval = interval_ms / 1000
+        self.queue: "queue.Queue" = queue.Queue()
+        self.next_id: Optional[int] = None
+        self.id_lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def write(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Queue a message row and block until its batch has been committed.
+        """
+        return self.submit(values).result()
+
+    def submit(self, values: Dict[str, Any]) -> Future:
+        self._ensure_started()
+        values = dict(values)
+        values["id"] = self._allocate_id()
+        values.setdefault("created_at", datetime.utcnow())
+        future: Future = Future()
+        self.queue.put((values, future))
+        return future
+
+    def stop(self) -> None:
+        """
+        Flush everything still queued and stop the worker.
+        """
+        with self.id_lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        self.queue.put(_STOP)
+        thread.join()
+
+    def _ensure_started(self) -> None:
+        if self.thread is not None:
+            return
+        with self.id_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+                self.thread.start()
+
+    def _allocate_id(self) -> int:
+        with self.id_lock:
+            if self.next_id is None:
+                db = SessionLocal()
+                try:
+                    self.next_id = (db.query(func.max(models.Message.id)).scalar() or 0) + 1
+                finally:
+                    db.close()
+            message_id = self.next_id
+            self.next_id += 1
+            return message_id
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # Дописываем то, что успели положить в очередь до остановки
+        rest = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                rest.append(item)
+        if rest:
+            self._flush(rest)
+
+    def _flush(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        from crud import insert_messages  # import inside function to avoid circular dependency
+
+        db = SessionLocal()
+        try:
+            try:
+                insert_messages(db, [values for values, _ in batch])
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    return
+                print(f"Batch insert of {len(batch)} messages failed, retrying one by one: {e}")
+                for item in batch:
+                    self._flush([item])
+                return
+            for values, future in batch:
+                future.set_result(values)
+        finally:
+            db.close()
+
+# Create a global instance
+message_writer = MessageWriter(config.MESSAGE_BATCH_MAX_ROWS, config.MESSAGE_BATCH_INTERVAL_MS)
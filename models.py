@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Table, JSON, Enum
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Table, JSON, Enum, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -35,7 +35,9 @@ message_reactions = Table(
     Base.metadata,
     Column('message_id', Integer, ForeignKey('messages.id')),
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('emoji', String)
+    Column('emoji', String),
+    # Один пользователь ставит одну и ту же реакцию только один раз
+    Index('ux_message_reactions_message_user_emoji', 'message_id', 'user_id', 'emoji', unique=True)
 )
 
 class User(Base):
@@ -55,6 +57,8 @@ class User(Base):
     two_factor_secret = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     last_login = Column(DateTime(timezone=True), nullable=True)
+    # Увеличивается при отзыве токенов: токены со старой версией недействительны
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
     
     # Отношения
     owned_servers = relationship("Server", back_populates="owner")
@@ -146,7 +150,11 @@ class Message(Base):
     is_edited = Column(Boolean, default=False)
     attachments = Column(JSON, default=[])
     mentions = Column(JSON, default=[])
-    parent_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
+    role_mentions = Column(JSON, default=[])
+    parent_id = Column(Integer, ForeignKey("messages.id"), nullable=True, index=True)
+    # Счетчики ветки, чтобы показывать значок треда без лишних запросов
+    reply_count = Column(Integer, default=0, server_default="0", nullable=False)
+    last_reply_at = Column(DateTime(timezone=True), nullable=True)
 
     # Отношения
     author = relationship("User", back_populates="messages")
@@ -154,6 +162,51 @@ class Message(Base):
     reactions = relationship("User", secondary=message_reactions, back_populates="reactions")
     parent = relationship("Message", remote_side=[id], backref="replies")
 
+    __table_args__ = (
+        # Keyset-пагинация и подсчет непрочитанных по каналу
+        Index("ix_messages_channel_id_id", "channel_id", "id"),
+    )
+
+class MessageMention(Base):
+    __tablename__ = "message_mentions"
+
+    # Первичный ключ (user_id, message_id) служит индексом для ленты упоминаний
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), primary_key=True, index=True)
+    channel_id = Column(Integer, ForeignKey("channels.id"))
+
+    __table_args__ = (
+        Index("ix_message_mentions_user_channel", "user_id", "channel_id", "message_id"),
+    )
+
+class ReadState(Base):
+    __tablename__ = "read_states"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    channel_id = Column(Integer, ForeignKey("channels.id"), primary_key=True)
+    last_read_message_id = Column(Integer, default=0, server_default="0", nullable=False)
+    # Число упоминаний после last_read_message_id, поддерживается инкрементально
+    mention_count = Column(Integer, default=0, server_default="0", nullable=False)
+
+class ArchiveBlock(Base):
+    __tablename__ = "archive_blocks"
+
+    # Сжатый блок архивных сообщений канала внутри файла-сегмента
+    id = Column(Integer, primary_key=True, index=True)
+    channel_id = Column(Integer, ForeignKey("channels.id"))
+    min_message_id = Column(Integer)
+    max_message_id = Column(Integer)
+    message_count = Column(Integer)
+    segment = Column(String)
+    byte_offset = Column(Integer)
+    byte_length = Column(Integer)
+    codec = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_archive_blocks_channel_range", "channel_id", "max_message_id"),
+    )
+
 class AuditLog(Base):
     __tablename__ = "audit_logs"
 
@@ -168,6 +221,21 @@ class AuditLog(Base):
 
     server = relationship("Server", back_populates="audit_logs")
 
+class Blob(Base):
+    __tablename__ = "blobs"
+
+    # Файл лежит в BLOB_DIR по SHA-256 содержимого, одинаковые загрузки делят его
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    content_type = Column(String, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    released_at = Column(DateTime, nullable=True)  # Когда ref_count стал 0, для сборщика
+
+    __table_args__ = (
+        Index("ix_blobs_ref_count_released_at", "ref_count", "released_at"),
+    )
+
 class Media(Base):
     __tablename__ = "media"
 
@@ -178,6 +246,7 @@ class Media(Base):
     size = Column(Integer)
     duration = Column(Integer, nullable=True)  # Для аудио/видео
     thumbnail_url = Column(String, nullable=True)
+    sha256 = Column(String(64), ForeignKey("blobs.sha256"), nullable=True, index=True)  # NULL у старых загрузок
     uploaded_by_id = Column(Integer, ForeignKey("users.id"))
     channel_id = Column(Integer, ForeignKey("channels.id"))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -251,4 +320,11 @@ class ServerMember(Base):
 
     user = relationship("User", back_populates="server_memberships")
     server = relationship("Server", back_populates="members")
-    role = relationship("Role", back_populates="members") 
\ No newline at end of file
+    role = relationship("Role", back_populates="members") 
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+
+    # Общие счетчики версий для сброса кэшей в памяти между процессами
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0, server_default="0", nullable=False)
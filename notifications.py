@@ -0,0 +1,68 @@
+import asyncio
+import threading
+from typing import Any, Dict, Iterable, Optional, Set
+
+from fastapi import WebSocket
+
+# Уведомления пользователям через WebSocket.
+# Пользователь может быть подключен с нескольких устройств, поэтому на
+# каждого хранится множество сокетов. notify() можно вызывать из любого
+# потока: отправка планируется в цикл событий приложения.
+
+class NotificationManager:
+    def __init__(self):
+        self.connections: Dict[int, Set[WebSocket]] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+
+    async def connect(self, websocket: WebSocket, user_id: int):
+        await websocket.accept()
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.connections.setdefault(user_id, set()).add(websocket)
+
+    def disconnect(self, websocket: WebSocket, user_id: int):
+        with self.lock:
+            sockets = self.connections.get(user_id)
+            if sockets is None:
+                return
+            sockets.discard(websocket)
+            if not sockets:
+                del self.connections[user_id]
+
+    def is_online(self, user_id: int) -> bool:
+        with self.lock:
+            return user_id in self.connections
+
+    def notify(self, user_ids: Iterable[int], message: Dict[str, Any]):
+        """
+        Push an event to every online user in `user_ids`. Offline users are
+        skipped; they pick the event up from their inbox on reconnect.
+        """
+        with self.lock:
+            loop = self.loop
+            targets = [
+                websocket
+                for user_id in user_ids
+                for websocket in self.connections.get(user_id, ())
+            ]
+        if not targets or loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            loop.create_task(self._send(targets, message))
+        else:
+            asyncio.run_coroutine_threadsafe(self._send(targets, message), loop)
+
+    async def _send(self, targets, message: Dict[str, Any]):
+        for websocket in targets:
+            try:
+                await websocket.send_json(message)
+            except Exception as e:
+                print(f"Error sending notification: {e}")
+
+# Create a global instance
+notification_manager = NotificationManager()
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+from fastapi import HTTPException
+from sqlalchemy import update
+
+import config
+import models
+from database import SessionLocal
+
+# Пул для bcrypt.
+# Хэширование и проверка пароля занимают 100-300 мс процессора, поэтому они
+# выполняются в отдельном пуле потоков (bcrypt отпускает GIL), а не в цикле
+# событий или общем пуле FastAPI. Число задач в работе и в очереди
+# ограничено: при переполнении запрос сразу получает 429, а не ждет.
+
+class PasswordPool:
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.limit = workers + max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def submit(self, fn: Callable, *args: Any) -> Future:
+        """
+        Queue a job, or raise 429 if the pool is saturated.
+        """
+        with self.lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many password operations, try again later",
+                    headers={"Retry-After": "1"}
+                )
+            self.in_flight += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def run(self, fn: Callable, *args: Any) -> Any:
+        # Для синхронных маршрутов: поток запроса ждет результата
+        return self.submit(fn, *args).result()
+
+    async def run_async(self, fn: Callable, *args: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def rehash_in_background(self, user_id: int, plain_password: str, old_hash: str) -> None:
+        """
+        Re-hash a password stored with outdated parameters (e.g. a lower
+        bcrypt cost). Skipped when the pool is busy: it will be retried on
+        the next login.
+        """
+        try:
+            self.submit(self._rehash, user_id, plain_password, old_hash)
+        except HTTPException:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return {"workers": self.workers, "in_flight": self.in_flight, "rejected": self.rejected}
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def _done(self, future: Future) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def _rehash(self, user_id: int, plain_password: str, old_hash: str) -> None:
+        from auth import get_password_hash  # import inside function to avoid circular dependency
+
+        new_hash = get_password_hash(plain_password)
+        db = SessionLocal()
+        try:
+            # Пароль мог смениться, пока считался новый хэш
+            db.execute(
+                update(models.User)
+                .where(models.User.id == user_id, models.User.hashed_password == old_hash)
+                .values(hashed_password=new_hash)
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error rehashing password for user {user_id}: {e}")
+        finally:
+            db.close()
+
+# Create a global instance
+password_pool = PasswordPool(config.PASSWORD_POOL_WORKERS, config.PASSWORD_POOL_MAX_QUEUE)
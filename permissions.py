@@ -0,0 +1,97 @@
+import enum
+from typing import Any, Dict, Optional, Tuple
+
+from models import RoleType
+
+# Права участников в виде битовой маски.
+# Маска участника собирается один раз из типа роли, назначенной роли
+# (Role.permissions: {"manage_channels": true, "send_messages": false}) и
+# флага владельца, и хранится в кэше членства. Переопределения канала лежат в
+# Channel.settings["permission_overrides"]:
+#     {"everyone": {"allow": [...], "deny": [...]}, "<role_id>": {...}}
+# Проверка права - одна битовая операция.
+
+class Permission(enum.IntFlag):
+    VIEW_CHANNEL = 1 << 0
+    SEND_MESSAGES = 1 << 1
+    MANAGE_MESSAGES = 1 << 2
+    ADD_REACTIONS = 1 << 3
+    CONNECT = 1 << 4
+    SPEAK = 1 << 5
+    CREATE_INVITE = 1 << 6
+    MANAGE_CHANNELS = 1 << 7
+    MANAGE_ROLES = 1 << 8
+    MANAGE_SERVER = 1 << 9
+    VIEW_AUDIT_LOG = 1 << 10
+    KICK_MEMBERS = 1 << 11
+    ADMINISTRATOR = 1 << 12
+
+ALL_PERMISSIONS = 0
+for _permission in Permission:
+    ALL_PERMISSIONS |= _permission
+
+_MEMBER_DEFAULTS = (
+    Permission.VIEW_CHANNEL | Permission.SEND_MESSAGES | Permission.ADD_REACTIONS
+    | Permission.CONNECT | Permission.SPEAK | Permission.CREATE_INVITE
+)
+
+ROLE_TYPE_DEFAULTS = {
+    RoleType.MEMBER: int(_MEMBER_DEFAULTS),
+    RoleType.MODERATOR: int(
+        _MEMBER_DEFAULTS | Permission.MANAGE_MESSAGES | Permission.KICK_MEMBERS | Permission.VIEW_AUDIT_LOG
+    ),
+    RoleType.ADMIN: ALL_PERMISSIONS
+}
+
+def _mask(names) -> int:
+    mask = 0
+    for name in names or []:
+        permission = Permission.__members__.get(str(name).upper())
+        if permission is not None:
+            mask |= permission
+    return mask
+
+def compile_permissions(role_type: Optional[RoleType], role_permissions: Optional[Dict[str, Any]],
+                        is_owner: bool = False) -> int:
+    """
+    Server-wide permission mask of a member.
+    """
+    if is_owner:
+        return ALL_PERMISSIONS
+    mask = ROLE_TYPE_DEFAULTS.get(role_type, ROLE_TYPE_DEFAULTS[RoleType.MEMBER])
+    for name, value in (role_permissions or {}).items():
+        permission = Permission.__members__.get(str(name).upper())
+        if permission is None:
+            continue
+        if value:
+            mask |= permission
+        else:
+            mask &= ~permission
+    if mask & Permission.ADMINISTRATOR:
+        return ALL_PERMISSIONS
+    return mask
+
+def granted_permissions(role_permissions: Optional[Dict[str, Any]]) -> int:
+    """
+    Bits a role's permissions dict switches on.
+    """
+    return _mask(name for name, value in (role_permissions or {}).items() if value)
+
+def compile_overrides(settings: Optional[Dict[str, Any]]) -> Dict[str, Tuple[int, int]]:
+    """
+    Channel overrides as {"everyone" | role_id: (allow_mask, deny_mask)}.
+    """
+    overrides = (settings or {}).get("permission_overrides") or {}
+    return {
+        str(key): (_mask(value.get("allow")), _mask(value.get("deny")))
+        for key, value in overrides.items() if isinstance(value, dict)
+    }
+
+def apply_overrides(mask: int, role_id: Optional[int], overrides: Dict[str, Tuple[int, int]]) -> int:
+    if not overrides or mask & Permission.ADMINISTRATOR:
+        return mask
+    for key in ("everyone", str(role_id)):
+        if key in overrides:
+            allow, deny = overrides[key]
+            mask = (mask & ~deny) | allow
+    return mask
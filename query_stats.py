@@ -0,0 +1,109 @@
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+import config
+from database import async_engine, engine, read_engine
+
+# Счетчик запросов к БД на один HTTP-запрос.
+# События движков пишут в объект из contextvar, поэтому учитываются и
+# sync-маршруты в пуле потоков (контекст копируется), и async-маршруты.
+# Фоновые потоки (message_writer, read_states) в статистику не попадают.
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def repeated(self, threshold: int):
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start"].pop()
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.count += 1
+    stats.duration += time.perf_counter() - started
+    stats.statements[statement] += 1
+
+for _engine in (engine, read_engine, async_engine.sync_engine):
+    if _engine is not None:
+        event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+
+def query_budget(max_queries: int):
+    """
+    Declare how many queries a route may issue, e.g.
+
+        @app.get("/servers/{server_id}")
+        @query_budget(2)
+        def read_server(...):
+    """
+    def decorator(endpoint):
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorator
+
+class QueryStatsMiddleware:
+    """
+    Adds a Server-Timing header with the number of queries and DB time,
+    logs repeated identical statements (a likely N+1) and checks route
+    query budgets. With QUERY_BUDGET_STRICT an exceeded budget raises
+    QueryBudgetExceeded, which fails the request in tests.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                self._check_budget(scope, stats)
+                total = (time.perf_counter() - started) * 1000
+                timing = (
+                    f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries", '
+                    f"app;dur={total:.1f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+
+        for statement, count in stats.repeated(config.QUERY_REPEAT_THRESHOLD):
+            print(
+                f"Possible N+1 in {scope['method']} {scope['path']}: statement ran {count} times: "
+                f"{' '.join(statement.split())[:200]}"
+            )
+
+    def _check_budget(self, scope, stats: QueryStats):
+        endpoint = scope.get("endpoint")
+        budget = getattr(endpoint, "query_budget", config.QUERY_BUDGET_DEFAULT)
+        if budget is None or stats.count <= budget:
+            return
+        error = f"{scope['method']} {scope['path']} issued {stats.count} queries, budget is {budget}"
+        if config.QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded(error)
+        print(f"Query budget exceeded: {error}")
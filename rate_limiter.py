@@ -0,0 +1,195 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import config
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+# Ограничение частоты попыток входа.
+# Скользящее окно считается по двум соседним фиксированным окнам: счетчик
+# прошлого окна берется с весом оставшейся доли, так что на ключ хранится
+# всего три числа. Проверка идет до любых запросов к БД и bcrypt, отказ стоит
+# одну операцию со словарем. Устаревшие ключи вычищаются раз в окно, число
+# ключей ограничено. С RATE_LIMIT_REDIS_URL счетчики общие для всех воркеров.
+
+class _MemoryStore:
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # key -> [индекс окна, счетчик прошлого окна, счетчик текущего окна]
+        self.counters: "OrderedDict[str, list]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.swept_at = 0
+
+    async def counts(self, key: str, index: int) -> Tuple[int, int]:
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                return 0, 0
+            return self._roll(counter, index)[1:]
+
+    async def incr(self, key: str, index: int) -> Tuple[int, int]:
+        with self.lock:
+            if index != self.swept_at:
+                self._sweep(index)
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = [index, 0, 0]
+                if len(self.counters) > self.max_keys:
+                    self.counters.popitem(last=False)
+            else:
+                self._roll(counter, index)
+                self.counters.move_to_end(key)
+            counter[2] += 1
+            return counter[1], counter[2]
+
+    async def decr(self, key: str, index: int) -> None:
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is not None:
+                self._roll(counter, index)
+                counter[2] = max(0, counter[2] - 1)
+
+    async def delete(self, key: str) -> None:
+        with self.lock:
+            self.counters.pop(key, None)
+
+    def _roll(self, counter: list, index: int) -> list:
+        if counter[0] != index:
+            counter[1] = counter[2] if counter[0] == index - 1 else 0
+            counter[2] = 0
+            counter[0] = index
+        return counter
+
+    def _sweep(self, index: int) -> None:
+        # Ключи, не тронутые два окна, уже ничего не ограничивают
+        self.swept_at = index
+        for key in [key for key, counter in self.counters.items() if counter[0] < index - 1]:
+            del self.counters[key]
+
+class _RedisStore:
+    def __init__(self, client, prefix: str, window: float):
+        self.client = client
+        self.prefix = prefix
+        self.window = window
+        self.ttl = int(math.ceil(window * 2))
+
+    async def counts(self, key: str, index: int) -> Tuple[int, int]:
+        previous, current = await self.client.mget(self._key(key, index - 1), self._key(key, index))
+        return int(previous or 0), int(current or 0)
+
+    async def incr(self, key: str, index: int) -> Tuple[int, int]:
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.incr(self._key(key, index))
+            pipe.expire(self._key(key, index), self.ttl)
+            pipe.get(self._key(key, index - 1))
+            current, _, previous = await pipe.execute()
+        return int(previous or 0), int(current)
+
+    async def decr(self, key: str, index: int) -> None:
+        await self.client.decr(self._key(key, index))
+
+    async def delete(self, key: str) -> None:
+        index = int(time.time() // self.window)
+        await self.client.delete(self._key(key, index - 1), self._key(key, index))
+
+    def _key(self, key: str, index: int) -> str:
+        return f"{self.prefix}:{key}:{index}"
+
+class SlidingWindowLimiter:
+    def __init__(self, name: str, limit: int, window_seconds: float, max_keys: int,
+                 redis_client=None):
+        self.limit = limit
+        self.window = window_seconds
+        if redis_client is not None:
+            self.store = _RedisStore(redis_client, f"ratelimit:{name}", window_seconds)
+        else:
+            self.store = _MemoryStore(max_keys)
+
+    async def hit(self, key: str) -> Optional[int]:
+        """
+        Count an attempt. Returns None if it is allowed, or the number of
+        seconds to wait if the limit is already reached (rejected attempts
+        are not counted). The slot is taken by the increment itself, so
+        parallel attempts cannot all pass before any of them is counted.
+        """
+        now = time.time()
+        index = self._index(now)
+        previous, current = await self.store.incr(key, index)
+        retry_after = self._retry_after(now, index, previous, current - 1)
+        if retry_after is not None:
+            await self.store.decr(key, index)
+        return retry_after
+
+    async def check(self, key: str) -> Optional[int]:
+        """
+        Like hit(), but without counting.
+        """
+        now = time.time()
+        index = self._index(now)
+        previous, current = await self.store.counts(key, index)
+        return self._retry_after(now, index, previous, current)
+
+    async def release(self, key: str) -> None:
+        """
+        Give back an attempt counted by hit().
+        """
+        await self.store.decr(key, self._index(time.time()))
+
+    async def reset(self, key: str) -> None:
+        await self.store.delete(key)
+
+    def _index(self, now: float) -> int:
+        return int(now // self.window)
+
+    def _retry_after(self, now: float, index: int, previous: int, current: int) -> Optional[int]:
+        elapsed = now / self.window - index
+        if previous * (1 - elapsed) + current < self.limit:
+            return None
+        return max(1, int(math.ceil((1 - elapsed) * self.window)))
+
+class LoginRateLimiter:
+    """
+    All attempts are limited per IP and per account. check() counts the
+    attempt against the account up front; a successful login clears the
+    account's counter, and attempts that ended without checking the
+    password are given back with release().
+    """
+    def __init__(self, redis_url: Optional[str] = None):
+        client = None
+        if redis_url:
+            if redis is None:
+                print("RATE_LIMIT_REDIS_URL is set but redis is not installed, using in-memory limits")
+            else:
+                client = redis.from_url(redis_url)
+        ip_limit, ip_window = config.LOGIN_RATE_LIMIT_PER_IP
+        account_limit, account_window = config.LOGIN_RATE_LIMIT_FAILURES_PER_ACCOUNT
+        self.by_ip = SlidingWindowLimiter(
+            "login:ip", ip_limit, ip_window, config.RATE_LIMIT_MAX_KEYS, client
+        )
+        self.by_account = SlidingWindowLimiter(
+            "login:account", account_limit, account_window, config.RATE_LIMIT_MAX_KEYS, client
+        )
+
+    async def check(self, ip_address: str, account: str) -> Optional[int]:
+        retry_after = await self.by_account.hit(account.lower())
+        if retry_after is not None:
+            return retry_after
+        retry_after = await self.by_ip.hit(ip_address)
+        if retry_after is not None:
+            await self.by_account.release(account.lower())
+        return retry_after
+
+    async def release(self, account: str) -> None:
+        await self.by_account.release(account.lower())
+
+    async def record_success(self, account: str) -> None:
+        await self.by_account.reset(account.lower())
+
+# Create a global instance
+login_rate_limiter = LoginRateLimiter(config.RATE_LIMIT_REDIS_URL)
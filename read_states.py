@@ -0,0 +1,86 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+import config
+from database import SessionLocal
+
+# Отметки о прочтении.
+# Клиент отправляет ack при каждой прокрутке, поэтому отметки копятся в памяти
+# (для пары пользователь/канал хранится только максимальный id) и пишутся в БД
+# одной транзакцией раз в READ_STATE_FLUSH_INTERVAL_MS.
+
+class ReadStateWriter:
+    def __init__(self, interval_ms: int):
+        self.interval = interval_ms / 1000
+        self.pending: Dict[Tuple[int, int], int] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+    def ack(self, user_id: int, channel_id: int, message_id: int) -> None:
+        self._ensure_started()
+        key = (user_id, channel_id)
+        with self.lock:
+            if message_id > self.pending.get(key, 0):
+                self.pending[key] = message_id
+
+    def has_pending(self, user_id: int) -> bool:
+        with self.lock:
+            return any(key[0] == user_id for key in self.pending)
+
+    def flush(self) -> None:
+        """
+        Write all coalesced acks in one transaction.
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if batch:
+                self._save(batch)
+
+    def _save(self, batch: Dict[Tuple[int, int], int]) -> None:
+        from crud import save_read_states  # import inside function to avoid circular dependency
+
+        db = SessionLocal()
+        try:
+            save_read_states(db, batch)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(batch) == 1:
+                print(f"Dropping read state {batch}: {e}")
+                return
+            # Одна плохая строка не должна задерживать остальные
+            print(f"Saving {len(batch)} read states failed, retrying one by one: {e}")
+            for key, message_id in batch.items():
+                self._save({key: message_id})
+        finally:
+            db.close()
+
+    def stop(self) -> None:
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def _ensure_started(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.running = True
+                self.wakeup.clear()
+                self.thread = threading.Thread(target=self._run, name="read-state-writer", daemon=True)
+                self.thread.start()
+
+    def _run(self) -> None:
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.flush()
+
+# Create a global instance
+read_state_writer = ReadStateWriter(config.READ_STATE_FLUSH_INTERVAL_MS)
@@ -89,6 +89,17 @@ class Role(RoleBase):
     class Config:
         from_attributes = True
 
+class ServerMember(BaseModel):
+    id: int
+    user_id: int
+    server_id: int
+    role_id: Optional[int] = None
+    role_type: RoleType
+    role: Optional[Role] = None
+
+    class Config:
+        from_attributes = True
+
 class ChannelBase(BaseModel):
     name: str = Field(..., min_length=1, max_length=32)
     type: ChannelType
@@ -115,10 +126,31 @@ class Channel(ChannelBase):
     class Config:
         from_attributes = True
 
+class ChannelWithReadState(Channel):
+    last_read_message_id: int = 0
+    unread_count: int = 0
+    mention_count: int = 0
+
+class ChannelCategory(ChannelWithReadState):
+    channels: List[ChannelWithReadState] = []
+
+class ServerBootstrap(BaseModel):
+    server: Server
+    roles: List[Role]
+    membership: ServerMember
+    permissions: int  # Маска Permission с учетом владельца и типа роли
+    member_count: int
+    categories: List[ChannelCategory]
+    channels: List[ChannelWithReadState]
+
+class ReadStateAck(BaseModel):
+    message_id: int
+
 class MessageBase(BaseModel):
     content: str
     attachments: Optional[List[Dict[str, Any]]] = []
     mentions: Optional[List[int]] = []
+    role_mentions: Optional[List[int]] = []
     parent_id: Optional[int] = None
 
 class MessageCreate(MessageBase):
@@ -128,6 +160,12 @@ class MessageUpdate(BaseModel):
     content: Optional[str] = None
     attachments: Optional[List[Dict[str, Any]]] = None
     mentions: Optional[List[int]] = None
+    role_mentions: Optional[List[int]] = None
+
+class ReactionCount(BaseModel):
+    emoji: str
+    count: int
+    me: bool = False
 
 class Message(MessageBase):
     id: int
@@ -136,10 +174,26 @@ class Message(MessageBase):
     created_at: datetime
     edited_at: Optional[datetime] = None
     is_edited: bool
+    reply_count: int = 0
+    last_reply_at: Optional[datetime] = None
+    is_archived: bool = False
+    reaction_counts: List[ReactionCount] = []
 
     class Config:
         from_attributes = True
 
+class ThreadMessage(Message):
+    depth: int
+
+class MessageThread(BaseModel):
+    root_id: int
+    messages: List[ThreadMessage]
+    next_cursor: Optional[int] = None
+
+class MentionPage(BaseModel):
+    messages: List[Message]
+    next_cursor: Optional[int] = None
+
 class MessageReaction(BaseModel):
     message_id: int
     user_id: int
@@ -184,8 +238,13 @@ class MediaBase(BaseModel):
 class MediaCreate(MediaBase):
     pass
 
+class MediaByHash(BaseModel):
+    sha256: str = Field(..., pattern="^[0-9a-f]{64}$")
+    name: str
+
 class Media(MediaBase):
     id: int
+    sha256: Optional[str] = None
     uploaded_by_id: int
     channel_id: int
     created_at: datetime
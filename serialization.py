@@ -0,0 +1,24 @@
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Type
+
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+
+# Быстрая сериализация списков.
+# С response_model FastAPI проверяет каждый элемент, переводит результат в
+# dict/list через jsonable_encoder и кодирует стандартным json. Здесь ORM-объекты
+# один раз проверяются заранее собранным TypeAdapter (from_attributes) и сразу
+# пишутся в JSON-байты в pydantic-core. response_model у маршрута остается
+# для документации: готовый Response FastAPI отдает как есть.
+
+@lru_cache(maxsize=None)
+def list_adapter(schema: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[schema])
+
+def dump_list(schema: Type[BaseModel], items: Sequence[Any]) -> bytes:
+    adapter = list_adapter(schema)
+    return adapter.dump_json(adapter.validate_python(items, from_attributes=True))
+
+def list_response(schema: Type[BaseModel], items: Sequence[Any],
+                  headers: Optional[Dict[str, str]] = None) -> Response:
+    return Response(content=dump_list(schema, items), media_type="application/json", headers=headers)
@@ -0,0 +1,44 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# База и загрузки задаются относительными путями, поэтому тесты работают
+# в отдельной временной папке, а не рядом с рабочей dump.db
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="chat-tests-"))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+_user_numbers = itertools.count(1)
+
+@pytest.fixture
+def register(client):
+    def register(password="secret123"):
+        name = f"user{next(_user_numbers)}"
+        email = f"{name}@example.com"
+        response = client.post("/users/", json={"email": email, "username": name, "password": password})
+        assert response.status_code == 200, response.text
+        response = client.post("/token", data={"username": email, "password": password})
+        assert response.status_code == 200, response.text
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    return register
+
+@pytest.fixture
+def server(client, register):
+    """
+    A server with one text channel, owned by a fresh user.
+    """
+    owner = register()
+    server_id = client.post("/servers/", json={"name": "Test server"}, headers=owner).json()["id"]
+    channel = client.post(
+        f"/servers/{server_id}/channels/", json={"name": "general", "type": "text"}, headers=owner
+    ).json()
+    return {"id": server_id, "channel_id": channel["id"], "owner": owner}
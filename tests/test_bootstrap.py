@@ -0,0 +1,12 @@
+from permissions import ALL_PERMISSIONS, ROLE_TYPE_DEFAULTS
+from models import RoleType
+
+def test_bootstrap_returns_effective_permissions(client, server, register):
+    member = register()
+    code = client.post(f"/servers/{server['id']}/invite", headers=server["owner"]).json()["code"]
+    assert client.post(f"/servers/join/{code}", headers=member).status_code == 200
+
+    owner_view = client.get(f"/servers/{server['id']}/bootstrap", headers=server["owner"]).json()
+    member_view = client.get(f"/servers/{server['id']}/bootstrap", headers=member).json()
+    assert owner_view["permissions"] == ALL_PERMISSIONS
+    assert member_view["permissions"] == ROLE_TYPE_DEFAULTS[RoleType.MEMBER]
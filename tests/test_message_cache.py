@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+
+import config
+import models
+from message_cache import MessageCache
+
+def _message(message_id):
+    return models.Message(
+        id=message_id, content=str(message_id), author_id=1, channel_id=1,
+        created_at=datetime.utcnow(), is_edited=False, reply_count=0
+    )
+
+def _page_ids(cache):
+    return [message["id"] for message in json.loads(cache.get_page(1, 10))]
+
+def test_add_message_keeps_id_order():
+    cache = MessageCache(50, 10 ** 7)
+    cache.fill(1, [_message(2), _message(1)], {}, cache.generation(1))
+    cache.add_message(_message(4))
+    cache.add_message(_message(3))
+    assert _page_ids(cache) == [4, 3, 2, 1]
+
+def test_page_order_under_concurrent_posts(client, server, monkeypatch):
+    monkeypatch.setattr(config, "MESSAGE_WRITE_PIPELINE", True)
+    channel_id, owner = server["channel_id"], server["owner"]
+    url = f"/channels/{channel_id}/messages/"
+    client.post(url, json={"content": "seed"}, headers=owner)
+    # Первая страница попадает в кэш, дальше кэш только дополняется
+    assert client.get(url, headers=owner).status_code == 200
+
+    def post(i):
+        return client.post(url, json={"content": f"message {i}"}, headers=owner).status_code
+
+    with ThreadPoolExecutor(16) as executor:
+        assert set(executor.map(post, range(200))) == {200}
+
+    ids = [message["id"] for message in client.get(url, params={"limit": 50}, headers=owner).json()]
+    assert len(ids) == 50
+    assert ids == sorted(ids, reverse=True)
@@ -0,0 +1,64 @@
+import pytest
+
+import config
+from archive import archive_index
+from etags import resource_versions
+from membership_cache import membership_cache
+from message_cache import message_cache
+from user_cache import user_cache
+
+# Бюджеты маршрутов проверяются на холодных кэшах: это худший случай, и
+# именно его должен покрывать @query_budget
+
+def _cool_down(channel_id):
+    membership_cache.clear()
+    membership_cache.checked_at = 0.0
+    user_cache.clear()
+    resource_versions.checked_at = 0.0
+    archive_index.flags.clear()
+    archive_index.checked_at = 0.0
+    message_cache.drop_channel(channel_id)
+
+@pytest.fixture
+def strict_client(client, monkeypatch):
+    monkeypatch.setattr(config, "QUERY_BUDGET_STRICT", True)
+    return client
+
+def test_hot_routes_stay_within_budget_on_cold_caches(strict_client, server):
+    client, owner = strict_client, server["owner"]
+    server_id, channel_id = server["id"], server["channel_id"]
+    role_id = client.post(
+        f"/servers/{server_id}/roles/", json={"name": "Role", "color": "#fff", "permissions": {}}, headers=owner
+    ).json()["id"]
+    message_id = client.post(f"/channels/{channel_id}/messages/", json={"content": "root"}, headers=owner).json()["id"]
+
+    requests = [
+        ("GET", "/users/me/", {}),
+        ("GET", "/servers/", {}),
+        ("GET", f"/servers/{server_id}", {}),
+        ("GET", f"/servers/{server_id}", {"headers": {"If-None-Match": "*"}}),
+        ("GET", f"/servers/{server_id}/bootstrap", {}),
+        ("GET", f"/servers/{server_id}/channels/", {}),
+        ("GET", f"/servers/{server_id}/roles/", {}),
+        ("POST", f"/servers/{server_id}/roles/", {"json": {"name": "Other", "color": "#000", "permissions": {}}}),
+        ("PUT", f"/roles/{role_id}", {"json": {"name": "Renamed", "permissions": {"send_messages": True}}}),
+        ("POST", f"/channels/{channel_id}/messages/", {"json": {"content": "hello"}}),
+        ("POST", f"/channels/{channel_id}/messages/", {"json": {"content": "reply", "parent_id": message_id}}),
+        ("GET", f"/channels/{channel_id}/messages/", {}),
+        ("POST", f"/channels/{channel_id}/ack", {"json": {"message_id": message_id}}),
+        ("POST", f"/messages/{message_id}/reactions/ok", {}),
+        ("DELETE", f"/messages/{message_id}/reactions/ok", {}),
+        ("GET", f"/messages/{message_id}/thread", {}),
+        ("PUT", f"/messages/{message_id}", {"json": {"content": "edited"}}),
+    ]
+    for method, url, options in requests:
+        _cool_down(channel_id)
+        headers = {**owner, **options.pop("headers", {})}
+        response = client.request(method, url, headers=headers, **options)
+        assert response.status_code < 400, (method, url, response.text)
+
+    # Чтение каналов сначала сбрасывает свои отложенные отметки о прочтении
+    for url in (f"/servers/{server_id}/bootstrap", f"/servers/{server_id}/channels/"):
+        client.post(f"/channels/{channel_id}/ack", json={"message_id": message_id}, headers=owner)
+        _cool_down(channel_id)
+        assert client.get(url, headers=owner).status_code == 200
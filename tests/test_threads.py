@@ -0,0 +1,17 @@
+def test_deleting_replies_updates_last_reply_at(client, server):
+    owner, channel_id = server["owner"], server["channel_id"]
+    url = f"/channels/{channel_id}/messages/"
+    root_id = client.post(url, json={"content": "root"}, headers=owner).json()["id"]
+    first = client.post(url, json={"content": "first", "parent_id": root_id}, headers=owner).json()
+    second = client.post(url, json={"content": "second", "parent_id": root_id}, headers=owner).json()
+
+    def root():
+        return client.get(f"/messages/{root_id}/thread", headers=owner).json()["messages"][0]
+
+    assert root()["reply_count"] == 2
+    assert client.delete(f"/messages/{second['id']}", headers=owner).status_code == 200
+    assert root()["reply_count"] == 1
+    assert root()["last_reply_at"] == first["created_at"]
+    assert client.delete(f"/messages/{first['id']}", headers=owner).status_code == 200
+    assert root()["reply_count"] == 0
+    assert root()["last_reply_at"] is None
@@ -0,0 +1,65 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict
+
+from jose import jwt
+from jose.exceptions import ExpiredSignatureError
+
+import config
+
+# Кэш проверенных JWT.
+# Подпись и разбор токена делаются один раз, дальше claims берутся по
+# дайджесту токена. Срок действия (exp) проверяется при каждом чтении, а
+# отзыв токенов - по token_version пользователя в auth.
+
+class TokenCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, token: str, verify_exp: bool = True) -> Dict[str, Any]:
+        """
+        Claims of a token with a valid signature. Raises JWTError (or
+        ExpiredSignatureError if verify_exp is set and the token expired).
+        The returned dict is shared, callers must not modify it.
+        """
+        key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        with self.lock:
+            claims = self.entries.get(key)
+            if claims is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if claims is None:
+            # exp проверяем сами ниже, чтобы истекший токен тоже попал в кэш
+            claims = jwt.decode(
+                token, config.SECRET_KEY, algorithms=[config.ALGORITHM], options={"verify_exp": False}
+            )
+            with self.lock:
+                self.entries[key] = claims
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        if verify_exp:
+            exp = claims.get("exp")
+            if exp is not None and exp <= time.time():
+                raise ExpiredSignatureError("Signature has expired.")
+        return claims
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.entries)
+            }
+
+# Create a global instance
+token_cache = TokenCache(config.TOKEN_CACHE_MAX_ENTRIES)
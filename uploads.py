@@ -0,0 +1,165 @@
+import hashlib
+import os
+import tempfile
+from typing import List, Optional
+
+from fastapi import HTTPException, Request
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+import config
+
+# Потоковая загрузка файлов.
+# Тело multipart-запроса разбирается по мере поступления и пишется кусками в
+# временный файл в UPLOAD_DIR, так что память на загрузку не зависит от
+# размера файла. Лимит MAX_UPLOAD_SIZE проверяется по Content-Length до чтения
+# и по фактически полученным байтам. Попутно считается SHA-256 содержимого:
+# по нему blob_store кладет файл или находит уже сохраненную копию.
+
+# Запас на заголовки частей multipart сверх размера файла
+_MULTIPART_OVERHEAD = 64 * 1024
+
+class StoredUpload:
+    __slots__ = ("path", "filename", "content_type", "size", "sha256")
+
+    def __init__(self, path: Optional[str], filename: str, content_type: str, size: int, sha256: str):
+        self.path = path  # Временный файл, None если содержимое не записывалось
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+
+    def discard(self) -> None:
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+def _allowed_extensions():
+    return {extension for extensions in config.ALLOWED_EXTENSIONS.values() for extension in extensions}
+
+def _extension(filename: str) -> str:
+    return os.path.splitext(filename)[1].lstrip(".").lower()
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"File is larger than {config.MAX_UPLOAD_SIZE} bytes"
+    )
+
+async def receive_upload(request: Request, field_name: str = "file", write: bool = True) -> StoredUpload:
+    """
+    Stream the file part `field_name` of a multipart request to a temporary
+    file, hashing it on the way. With write=False the content is only hashed,
+    for files whose blob is already stored. The caller owns the temporary
+    file: it is moved into the blob store or discarded.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and \
+            int(content_length) > config.MAX_UPLOAD_SIZE + _MULTIPART_OVERHEAD:
+        raise _too_large()
+
+    os.makedirs(config.UPLOAD_DIR, exist_ok=True)
+    state = {
+        "header_field": b"", "header_value": b"", "headers": {},
+        "in_file": False, "filename": None, "content_type": None,
+        "size": 0, "done": False, "error": None
+    }
+    pending: List[bytes] = []
+    digest = hashlib.sha256()
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = state["header_value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        filename = disposition.get(b"filename")
+        state["in_file"] = (
+            not state["done"] and disposition.get(b"name") == field_name.encode() and filename is not None
+        )
+        if not state["in_file"]:
+            return
+        # Берем только имя файла, без пути клиента
+        name = os.path.basename(filename.decode("utf-8", "replace").replace("\\", "/"))
+        if _extension(name) not in _allowed_extensions():
+            state["error"] = HTTPException(status_code=400, detail="File type is not allowed")
+        state["filename"] = name
+        state["content_type"] = state["headers"].get(b"content-type", b"application/octet-stream").decode("latin-1")
+
+    def on_part_data(data, start, end):
+        if not state["in_file"] or state["error"] is not None:
+            return
+        state["size"] += end - start
+        if state["size"] > config.MAX_UPLOAD_SIZE:
+            state["error"] = _too_large()
+            return
+        digest.update(data[start:end])
+        if write:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        if state["in_file"]:
+            state["in_file"] = False
+            state["done"] = True
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end
+    })
+
+    temp = None
+    if write:
+        temp = await run_in_threadpool(
+            tempfile.NamedTemporaryFile, dir=config.UPLOAD_DIR, prefix=".upload-", delete=False
+        )
+    stored: Optional[StoredUpload] = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if state["error"] is not None:
+                raise state["error"]
+            if pending:
+                # Запись на диск в пуле потоков, цикл событий не ждет диск
+                await run_in_threadpool(temp.write, b"".join(pending))
+                pending.clear()
+        parser.finalize()
+        if not state["done"]:
+            raise HTTPException(status_code=400, detail=f"Missing file field '{field_name}'")
+        if temp is not None:
+            await run_in_threadpool(temp.close)
+        stored = StoredUpload(
+            temp.name if temp is not None else None,
+            state["filename"], state["content_type"], state["size"], digest.hexdigest()
+        )
+        return stored
+    finally:
+        if stored is None and temp is not None:
+            await run_in_threadpool(_discard, temp)
+
+def _discard(temp) -> None:
+    temp.close()
+    try:
+        os.unlink(temp.name)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import select
+
+import config
+import models
+
+# Кэш пользователей для аутентификации.
+# get_current_user вызывается на каждом запросе, поэтому по subject токена
+# (email) хранится легкий снимок пользователя без привязки к сессии.
+# Записи живут USER_CACHE_TTL_SECONDS: изменения из других процессов видны не
+# позже этого срока, изменения этого процесса сбрасывают запись после коммита.
+# Маршруты, которые меняют пользователя, загружают ORM-объект сами.
+
+_MISSING = object()
+
+class UserSnapshot:
+    __slots__ = (
+        "id", "email", "username", "avatar_url", "banner_url", "bio", "status",
+        "is_active", "is_verified", "two_factor_enabled", "created_at", "last_login", "token_version"
+    )
+
+    def __init__(self, id: int, email: str, username: str, avatar_url: Optional[str],
+                 banner_url: Optional[str], bio: Optional[str], status: Optional[str],
+                 is_active: bool, is_verified: bool, two_factor_enabled: bool,
+                 created_at: datetime, last_login: Optional[datetime], token_version: int):
+        self.id = id
+        self.email = email
+        self.username = username
+        self.avatar_url = avatar_url
+        self.banner_url = banner_url
+        self.bio = bio
+        self.status = status
+        self.is_active = is_active
+        self.is_verified = is_verified
+        self.two_factor_enabled = two_factor_enabled
+        self.created_at = created_at
+        self.last_login = last_login
+        self.token_version = token_version
+
+def _user_statement(email: str):
+    return select(*[getattr(models.User, name) for name in UserSnapshot.__slots__])\
+        .where(models.User.email == email)
+
+class UserCache:
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        # email -> (снимок или None, время загрузки)
+        self.entries: "OrderedDict[str, Tuple[Optional[UserSnapshot], float]]" = OrderedDict()
+        self.emails: Dict[int, str] = {}
+        # Счетчики сбросов: загрузка, начатая до сброса, не попадает в кэш
+        self.generations: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db, email: str) -> Optional[UserSnapshot]:
+        """
+        Snapshot of the user with this email, or None if there is none.
+        """
+        snapshot, generation = self._lookup(email)
+        if snapshot is not _MISSING:
+            return snapshot
+        row = db.execute(_user_statement(email)).first()
+        return self._store(email, row, generation)
+
+    async def get_async(self, db, email: str) -> Optional[UserSnapshot]:
+        snapshot, generation = self._lookup(email)
+        if snapshot is not _MISSING:
+            return snapshot
+        row = (await db.execute(_user_statement(email))).first()
+        return self._store(email, row, generation)
+
+    def invalidate(self, user_id: Optional[int] = None, email: Optional[str] = None) -> None:
+        with self.lock:
+            if email is None:
+                email = self.emails.get(user_id)
+                if email is None:
+                    return
+            self.generations[email] = self.generations.get(email, 0) + 1
+            entry = self.entries.pop(email, None)
+            if entry is not None and entry[0] is not None:
+                self.emails.pop(entry[0].id, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            for email in self.entries:
+                self.generations[email] = self.generations.get(email, 0) + 1
+            self.entries.clear()
+            self.emails.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.entries)
+            }
+
+    def _lookup(self, email: str):
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self.entries.move_to_end(email)
+                self.hits += 1
+                return entry[0], self.generations.get(email, 0)
+            self.misses += 1
+            return _MISSING, self.generations.get(email, 0)
+
+    def _store(self, email: str, row, generation: int) -> Optional[UserSnapshot]:
+        snapshot = UserSnapshot(*row) if row is not None else None
+        with self.lock:
+            if self.generations.get(email, 0) != generation:
+                return snapshot
+            self.entries[email] = (snapshot, time.monotonic())
+            self.entries.move_to_end(email)
+            if snapshot is not None:
+                self.emails[snapshot.id] = email
+            while len(self.entries) > self.max_entries:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                if evicted is not None:
+                    self.emails.pop(evicted.id, None)
+        return snapshot
+
+# Create a global instance
+user_cache = UserCache(config.USER_CACHE_TTL_SECONDS, config.USER_CACHE_MAX_ENTRIES)